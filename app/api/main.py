@@ -13,6 +13,8 @@ from app.api.routers import (
     venv,
     venv_package,
     journal,
+    executor,
+    job,
 )
 
 router = APIRouter()
@@ -36,3 +38,5 @@ router.include_router(
     venv_package.router, prefix="/venv_package", tags=["venv_package"]
 )
 router.include_router(journal.router, prefix="/journal", tags=["journal"])
+router.include_router(executor.router, prefix="/executor", tags=["executor"])
+router.include_router(job.router, prefix="/job", tags=["job"])
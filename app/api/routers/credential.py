@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from sqlmodel import select
 
 from app.database import SessionDep
@@ -8,6 +8,7 @@ from app.models import (
     CredentialPublic,
     CredentialUpdate,
 )
+from app.pagination import PaginationDep, paginate
 
 router = APIRouter()
 
@@ -29,8 +30,21 @@ def create_credential(*, session: SessionDep, credential: CredentialCreate):
 
 
 @router.get("", response_model=list[CredentialPublic])
-def read_credential(*, session: SessionDep):
-    credentials = session.exec(select(Credential)).all()
+def read_credential(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    name: str | None = None,
+):
+    credentials = paginate(
+        session=session,
+        response=response,
+        model=Credential,
+        pagination=pagination,
+        sorts=["id", "name"],
+        filters={"name": name},
+    )
     return credentials
 
 
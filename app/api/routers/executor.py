@@ -0,0 +1,10 @@
+from fastapi import APIRouter
+
+from app.executor import executor
+
+router = APIRouter()
+
+
+@router.get("")
+def read_executor():
+    return executor.stats()
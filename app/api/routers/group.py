@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from sqlmodel import select
 
 from app.database import SessionDep
@@ -9,6 +9,7 @@ from app.models import (
     GroupPublicWithUsers,
     GroupUpdate,
 )
+from app.pagination import PaginationDep, paginate
 
 router = APIRouter()
 
@@ -30,8 +31,21 @@ def create_group(*, session: SessionDep, group: GroupCreate):
 
 
 @router.get("", response_model=list[GroupPublic])
-def read_group(*, session: SessionDep):
-    groups = session.exec(select(Group)).all()
+def read_group(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    name: str | None = None,
+):
+    groups = paginate(
+        session=session,
+        response=response,
+        model=Group,
+        pagination=pagination,
+        sorts=["id", "name"],
+        filters={"name": name},
+    )
     return groups
 
 
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from sqlmodel import select
 
 from app.database import SessionDep
@@ -8,6 +8,7 @@ from app.models import (
     InventoryPublic,
     InventoryUpdate,
 )
+from app.pagination import PaginationDep, paginate
 
 router = APIRouter()
 
@@ -29,8 +30,21 @@ def create_inventory(*, session: SessionDep, inventory: InventoryCreate):
 
 
 @router.get("", response_model=list[InventoryPublic])
-def read_inventory(*, session: SessionDep):
-    inventories = session.exec(select(Inventory)).all()
+def read_inventory(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    name: str | None = None,
+):
+    inventories = paginate(
+        session=session,
+        response=response,
+        model=Inventory,
+        pagination=pagination,
+        sorts=["id", "name"],
+        filters={"name": name},
+    )
     return inventories
 
 
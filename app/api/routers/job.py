@@ -0,0 +1,45 @@
+import uuid
+
+from fastapi import APIRouter, HTTPException, Response
+
+from app.database import SessionDep
+from app.models import (
+    Job,
+    JobPublic,
+    JobStateEnum,
+)
+from app.pagination import PaginationDep, paginate
+
+router = APIRouter()
+
+
+@router.get("", response_model=list[JobPublic])
+def read_job(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    kind: str | None = None,
+    state: JobStateEnum | None = None,
+    unit_id: uuid.UUID | None = None,
+):
+    jobs = paginate(
+        session=session,
+        response=response,
+        model=Job,
+        pagination=pagination,
+        sorts=["id", "created_at"],
+        filters={"kind": kind, "state": state, "unit_id": unit_id},
+    )
+    return jobs
+
+
+@router.get("/{job_id}", response_model=JobPublic)
+def read_job_by_id(*, session: SessionDep, job_id: uuid.UUID):
+    db_job = session.get(Job, job_id)
+    if not db_job:
+        raise HTTPException(
+            status_code=404,
+            detail="The job with this id does not exist in the system",
+        )
+    return db_job
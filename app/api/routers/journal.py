@@ -1,34 +1,145 @@
 import uuid
+from typing import Annotated
 
-from fastapi import APIRouter, HTTPException
-from sqlmodel import select
+from fastapi import APIRouter, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlmodel import col, select
 
 from app.database import SessionDep
+from app.executor import executor
 from app.models import (
+    ActiveEnum,
+    JobPublic,
     Journal,
+    Journal_Message,
+    Journal_Task,
+    Journal_TaskPublic,
     JournalPublic,
     JournalPublicWithMessages,
 )
+from app.pagination import PaginationDep, paginate
+from app import utils
 
 
 router = APIRouter()
 
 
 @router.get("", response_model=list[JournalPublic])
-def read_journal(*, session: SessionDep):
-    journals = session.exec(select(Journal)).all()
+def read_journal(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    active: ActiveEnum | None = None,
+    unit_id: uuid.UUID | None = None,
+):
+    journals = paginate(
+        session=session,
+        response=response,
+        model=Journal,
+        pagination=pagination,
+        sorts=["id", "finished_at", "started_at"],
+        filters={"active": active, "unit_id": unit_id},
+    )
     return journals
 
 
 @router.get("/{journal_id}", response_model=JournalPublicWithMessages)
-def read_journal_by_id(*, session: SessionDep, journal_id: uuid.UUID):
+def read_journal_by_id(
+    *,
+    session: SessionDep,
+    journal_id: uuid.UUID,
+    after_id: Annotated[int | None, Query(ge=0)] = None,
+    limit: Annotated[int | None, Query(ge=1)] = None,
+    tail: Annotated[int | None, Query(ge=1)] = None,
+):
+    if limit is not None and tail is not None:
+        raise HTTPException(
+            status_code=400,
+            detail="The limit and tail parameters can not be used together",
+        )
+    db_journal = session.get(Journal, journal_id)
+    if not db_journal:
+        raise HTTPException(
+            status_code=404,
+            detail="The journal with this id does not exist in the system",
+        )
+    statement = select(Journal_Message).where(Journal_Message.journal_id == journal_id)
+    if after_id is not None:
+        statement = statement.where(col(Journal_Message.id) > after_id)
+    if tail is not None:
+        statement = statement.order_by(col(Journal_Message.id).desc()).limit(tail)
+        db_journal_messages = list(reversed(session.exec(statement).all()))
+    else:
+        statement = statement.order_by(col(Journal_Message.id)).limit(limit)
+        db_journal_messages = list(session.exec(statement).all())
+    db_journal_with_messages = JournalPublicWithMessages.model_validate(
+        db_journal, update={"messages": db_journal_messages}
+    )
+    return db_journal_with_messages
+
+
+@router.get("/{journal_id}/tasks", response_model=list[Journal_TaskPublic])
+def read_journal_tasks_by_id(
+    *,
+    session: SessionDep,
+    journal_id: uuid.UUID,
+    after_id: Annotated[int | None, Query(ge=0)] = None,
+    limit: Annotated[int | None, Query(ge=1)] = None,
+):
+    db_journal = session.get(Journal, journal_id)
+    if not db_journal:
+        raise HTTPException(
+            status_code=404,
+            detail="The journal with this id does not exist in the system",
+        )
+    statement = select(Journal_Task).where(Journal_Task.journal_id == journal_id)
+    if after_id is not None:
+        statement = statement.where(col(Journal_Task.id) > after_id)
+    statement = statement.order_by(col(Journal_Task.id)).limit(limit)
+    db_journal_tasks = session.exec(statement).all()
+    return db_journal_tasks
+
+
+@router.post("/{journal_id}/cancel", response_model=JobPublic)
+def cancel_journal_by_id(*, session: SessionDep, journal_id: uuid.UUID):
+    db_journal = session.get(Journal, journal_id)
+    if not db_journal:
+        raise HTTPException(
+            status_code=404,
+            detail="The journal with this id does not exist in the system",
+        )
+    if executor.batched(session=session, journal_id=journal_id):
+        raise HTTPException(
+            status_code=409,
+            detail="The journal with this id runs in a batch, cancel the batch journal",
+        )
+    db_job = executor.cancel(session=session, journal_id=journal_id)
+    if not db_job:
+        raise HTTPException(
+            status_code=409,
+            detail="The journal with this id has no queued or running job",
+        )
+    return db_job
+
+
+@router.get("/{journal_id}/stream")
+def stream_journal_by_id(
+    *,
+    session: SessionDep,
+    journal_id: uuid.UUID,
+    last_event_id: Annotated[int | None, Header()] = None,
+):
     db_journal = session.get(Journal, journal_id)
     if not db_journal:
         raise HTTPException(
             status_code=404,
             detail="The journal with this id does not exist in the system",
         )
-    return db_journal
+    return StreamingResponse(
+        utils.stream_journal(journal_id=journal_id, after_id=last_event_id),
+        media_type="text/event-stream",
+    )
 
 
 @router.get("/unit/{unit_id}", response_model=list[JournalPublic])
@@ -1,23 +1,29 @@
 import uuid
 from pathlib import Path
 
-from fastapi import APIRouter, BackgroundTasks, HTTPException
-from sqlmodel import select
+from fastapi import APIRouter, HTTPException, Response
+from sqlmodel import col, select
 
 from app.config import settings
 from app.database import SessionDep
+from app.executor import executor
 from app.models import (
-    JournalCreate,
+    JobCreate,
     Repository,
     RepositoryCreate,
+    RepositoryInstall,
     RepositoryPublic,
     RepositoryPublicWithJournal,
     RepositoryPublicWithLinks,
     RepositoryUpdate,
+    Repository_Playbook,
+    Repository_PlaybookKindEnum,
+    Repository_PlaybookPublic,
     Venv,
     Venv_Package,
 )
-from app import utils
+from app.pagination import PaginationDep, paginate
+from app import repositories
 
 router = APIRouter()
 
@@ -26,7 +32,6 @@ router = APIRouter()
 def create_repository(
     *,
     session: SessionDep,
-    background_tasks: BackgroundTasks,
     repository: RepositoryCreate,
 ):
     statement = select(Repository).where(Repository.name == repository.name)
@@ -58,42 +63,77 @@ def create_repository(
         )
     db_repository = Repository.model_validate(repository)
     session.add(db_repository)
-    db_journal_id = utils.create_journal(
-        session=session, journal=(JournalCreate(unit_id=db_repository.id))
-    )
-    background_tasks.add_task(
-        utils.run_ansible_playbook,
+    db_job = executor.submit(
         session=session,
-        venv_directory=str(Path(settings.venv_dir) / str(db_repository.venv_id)),
-        playbook="app/playbooks/repository.yml",
-        options={
-            "extra_vars": {
-                "repository_directory": str(
-                    Path(settings.repository_dir).resolve() / str(db_repository.id)
-                ),
+        job=JobCreate(
+            kind="repository",
+            options={
+                "extra_vars": {
+                    "repository_directory": str(
+                        Path(settings.repository_dir).resolve() / str(db_repository.id)
+                    ),
+                },
+                "inventory": "localhost,",
             },
-            "inventory": "localhost,",
-            "tags": "create",
-        },
-        journal_id=db_journal_id,
+            playbook="app/playbooks/repository.yml",
+            tags="create",
+            unit_id=db_repository.id,
+            venv_directory=str(Path(settings.venv_dir) / str(db_repository.venv_id)),
+        ),
     )
     session.commit()
     session.refresh(db_repository)
-    db_repository_journal = RepositoryPublicWithJournal(
-        name=db_repository.name,
-        url=db_repository.url,
-        id=db_repository.id,
-        journal_id=db_journal_id,
+    db_repository_journal = RepositoryPublicWithJournal.model_validate(
+        db_repository, update={"journal_id": db_job.journal_id}
     )
     return db_repository_journal
 
 
 @router.get("", response_model=list[RepositoryPublic])
-def read_repository(*, session: SessionDep):
-    repositories = session.exec(select(Repository)).all()
+def read_repository(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    name: str | None = None,
+    url: str | None = None,
+    venv_id: uuid.UUID | None = None,
+):
+    repositories = paginate(
+        session=session,
+        response=response,
+        model=Repository,
+        pagination=pagination,
+        sorts=["id", "name"],
+        filters={"name": name, "url": url, "venv_id": venv_id},
+    )
     return repositories
 
 
+@router.get("/playbooks", response_model=list[Repository_PlaybookPublic])
+def read_repository_playbooks(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    kind: Repository_PlaybookKindEnum | None = None,
+    name: str | None = None,
+    path: str | None = None,
+):
+    playbooks = paginate(
+        session=session,
+        response=response,
+        model=Repository_Playbook,
+        pagination=pagination,
+        sorts=["id", "name", "path"],
+        filters={"kind": kind, "name": name},
+        where=[col(Repository_Playbook.path).contains(path, autoescape=True)]
+        if path is not None
+        else None,
+    )
+    return playbooks
+
+
 @router.get("/{repository_id}", response_model=RepositoryPublicWithLinks)
 def read_repository_by_id(*, session: SessionDep, repository_id: uuid.UUID):
     db_repository = session.get(Repository, repository_id)
@@ -134,6 +174,10 @@ def update_repository(
                     status_code=400,
                     detail="The venv with this id(venv_id) does not exist in the system",
                 )
+        if key in ("depth", "filter", "sparse_paths", "url") and value != getattr(
+            db_repository, key
+        ):
+            db_repository.commit = None
         setattr(db_repository, key, value)
     session.add(db_repository)
     session.commit()
@@ -142,9 +186,7 @@ def update_repository(
 
 
 @router.delete("/{repository_id}")
-def delete_repository(
-    *, session: SessionDep, background_tasks: BackgroundTasks, repository_id: uuid.UUID
-):
+def delete_repository(*, session: SessionDep, repository_id: uuid.UUID):
     db_repository = session.get(Repository, repository_id)
     if not db_repository:
         raise HTTPException(
@@ -166,39 +208,89 @@ def delete_repository(
             detail="The linked venv does not have the ansible package",
         )
     session.delete(db_repository)
-    db_journal_id = utils.create_journal(
-        session=session, journal=(JournalCreate(unit_id=db_repository.id))
-    )
-    background_tasks.add_task(
-        utils.run_ansible_playbook,
+    db_job = executor.submit(
         session=session,
-        venv_directory=str(Path(settings.venv_dir) / str(db_repository.venv_id)),
-        playbook="app/playbooks/repository.yml",
-        options={
-            "extra_vars": {
-                "repository_directory": str(
-                    Path(settings.repository_dir).resolve() / str(db_repository.id)
-                ),
+        job=JobCreate(
+            kind="repository",
+            options={
+                "extra_vars": {
+                    "repository_directory": str(
+                        Path(settings.repository_dir).resolve() / str(db_repository.id)
+                    ),
+                },
+                "inventory": "localhost,",
             },
-            "inventory": "localhost,",
-            "tags": "delete",
-        },
-        journal_id=db_journal_id,
+            playbook="app/playbooks/repository.yml",
+            tags="delete",
+            unit_id=db_repository.id,
+            venv_directory=str(Path(settings.venv_dir) / str(db_repository.venv_id)),
+        ),
     )
     session.commit()
-    db_repository_journal = RepositoryPublicWithJournal(
-        name=db_repository.name,
-        url=db_repository.url,
-        id=db_repository.id,
-        journal_id=db_journal_id,
+    db_repository_journal = RepositoryPublicWithJournal.model_validate(
+        db_repository, update={"journal_id": db_job.journal_id}
     )
     return db_repository_journal
 
 
+@router.post("/install")
+def install_repository(*, session: SessionDep, install: RepositoryInstall):
+    if install.ids is None and install.venv_id is None:
+        raise HTTPException(
+            status_code=400,
+            detail="The repositories to install need the ids or the venv_id",
+        )
+    statement = select(Repository)
+    if install.ids is not None:
+        statement = statement.where(col(Repository.id).in_(install.ids))
+    if install.venv_id is not None:
+        statement = statement.where(Repository.venv_id == install.venv_id)
+    db_repositories = session.exec(
+        statement.order_by(col(Repository.venv_id), col(Repository.id))
+    ).all()
+    if install.venv_id is None and len(db_repositories) != len(set(install.ids or [])):
+        raise HTTPException(
+            status_code=404,
+            detail="The repository with this id does not exist in the system",
+        )
+    groups: dict[uuid.UUID, list[Repository]] = {}
+    for db_repository in db_repositories:
+        groups.setdefault(db_repository.venv_id, []).append(db_repository)
+    for venv_id in groups:
+        statement = select(Venv_Package.name).where(Venv_Package.venv_id == venv_id)
+        db_venv_packages = session.exec(statement).all()
+        if len(db_venv_packages) == 0:
+            raise HTTPException(
+                status_code=404,
+                detail="The linked venv does not have any packages",
+            )
+        if "ansible" not in db_venv_packages:
+            raise HTTPException(
+                status_code=404,
+                detail="The linked venv does not have the ansible package",
+            )
+    batches = []
+    for venv_id, db_venv_repositories in groups.items():
+        journal_id, db_jobs = executor.submit_batch(
+            session=session,
+            unit_id=venv_id,
+            jobs=[
+                repositories.install_job(db_repository)
+                for db_repository in db_venv_repositories
+            ],
+        )
+        batches.append(
+            {
+                "journal_id": journal_id,
+                "journals": {db_job.unit_id: db_job.journal_id for db_job in db_jobs},
+                "venv_id": venv_id,
+            }
+        )
+    return {"ok": True, "batches": batches}
+
+
 @router.post("/{repository_id}/install")
-def install_repository_by_id(
-    *, session: SessionDep, background_tasks: BackgroundTasks, repository_id: uuid.UUID
-):
+def install_repository_by_id(*, session: SessionDep, repository_id: uuid.UUID):
     db_repository = session.get(Repository, repository_id)
     if not db_repository:
         raise HTTPException(
@@ -219,38 +311,42 @@ def install_repository_by_id(
             status_code=404,
             detail="The linked venv does not have the ansible package",
         )
-    db_journal_id = utils.create_journal(
-        session=session, journal=(JournalCreate(unit_id=db_repository.id))
+    db_job = executor.submit(
+        session=session, job=repositories.install_job(db_repository)
     )
-    background_tasks.add_task(
-        utils.run_ansible_playbook,
+    return {"ok": True, "journal_id": db_job.journal_id}
+
+
+@router.get(
+    "/{repository_id}/playbooks", response_model=list[Repository_PlaybookPublic]
+)
+def read_repository_playbooks_by_id(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    repository_id: uuid.UUID,
+    kind: Repository_PlaybookKindEnum | None = None,
+):
+    db_repository = session.get(Repository, repository_id)
+    if not db_repository:
+        raise HTTPException(
+            status_code=404,
+            detail="The repository with this id does not exist in the system",
+        )
+    playbooks = paginate(
         session=session,
-        venv_directory=str(Path(settings.venv_dir) / str(db_repository.venv_id)),
-        playbook="app/playbooks/repository.yml",
-        options={
-            "extra_vars": {
-                "repository_directory": str(
-                    Path(settings.repository_dir).resolve() / str(db_repository.id)
-                ),
-                "repository_url": str(db_repository.url),
-                **(
-                    {"repository_ref": str(db_repository.ref)}
-                    if db_repository.ref is not None
-                    else {}
-                ),
-            },
-            "inventory": "localhost,",
-            "tags": "install",
-        },
-        journal_id=db_journal_id,
+        response=response,
+        model=Repository_Playbook,
+        pagination=pagination,
+        sorts=["id", "name", "path"],
+        filters={"kind": kind, "repository_id": repository_id},
     )
-    return {"ok": True, "journal_id": db_journal_id}
+    return playbooks
 
 
 @router.post("/{repository_id}/uninstall")
-def uninstall_repository_by_id(
-    *, session: SessionDep, background_tasks: BackgroundTasks, repository_id: uuid.UUID
-):
+def uninstall_repository_by_id(*, session: SessionDep, repository_id: uuid.UUID):
     db_repository = session.get(Repository, repository_id)
     if not db_repository:
         raise HTTPException(
@@ -271,23 +367,22 @@ def uninstall_repository_by_id(
             status_code=404,
             detail="The linked venv does not have the ansible package",
         )
-    db_journal_id = utils.create_journal(
-        session=session, journal=(JournalCreate(unit_id=db_repository.id))
-    )
-    background_tasks.add_task(
-        utils.run_ansible_playbook,
+    db_job = executor.submit(
         session=session,
-        venv_directory=str(Path(settings.venv_dir) / str(db_repository.venv_id)),
-        playbook="app/playbooks/repository.yml",
-        options={
-            "extra_vars": {
-                "repository_directory": str(
-                    Path(settings.repository_dir).resolve() / str(db_repository.id)
-                ),
+        job=JobCreate(
+            kind="repository",
+            options={
+                "extra_vars": {
+                    "repository_directory": str(
+                        Path(settings.repository_dir).resolve() / str(db_repository.id)
+                    ),
+                },
+                "inventory": "localhost,",
             },
-            "inventory": "localhost,",
-            "tags": "uninstall",
-        },
-        journal_id=db_journal_id,
+            playbook="app/playbooks/repository.yml",
+            tags="uninstall",
+            unit_id=db_repository.id,
+            venv_directory=str(Path(settings.venv_dir) / str(db_repository.venv_id)),
+        ),
     )
-    return {"ok": True, "journal_id": db_journal_id}
+    return {"ok": True, "journal_id": db_job.journal_id}
@@ -1,6 +1,6 @@
 import uuid
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from sqlmodel import col, select
 
 from app.database import SessionDep
@@ -12,6 +12,7 @@ from app.models import (
     UserPublicWithGroups,
     UserUpdate,
 )
+from app.pagination import PaginationDep, paginate
 from app.security import create_password_hash, verify_password
 
 router = APIRouter()
@@ -36,8 +37,22 @@ def create_user(*, session: SessionDep, user: UserCreate):
 
 
 @router.get("", response_model=list[UserPublic])
-def read_user(*, session: SessionDep):
-    users = session.exec(select(User)).all()
+def read_user(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    is_active: bool | None = None,
+    username: str | None = None,
+):
+    users = paginate(
+        session=session,
+        response=response,
+        model=User,
+        pagination=pagination,
+        sorts=["id"],
+        filters={"is_active": is_active, "username": username},
+    )
     return users
 
 
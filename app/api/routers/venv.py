@@ -1,14 +1,18 @@
 import uuid
 from pathlib import Path
 
-from fastapi import APIRouter, BackgroundTasks, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from sqlmodel import select
 
 from app.config import settings
 from app.database import SessionDep
+from app.executor import executor
 from app.models import (
-    JournalCreate,
+    JobCreate,
     Venv,
+    Venv_InstalledPackagePublic,
+    Venv_Lock,
+    Venv_LockPublic,
     VenvCreate,
     VenvPublic,
     VenvPublicWithJournal,
@@ -16,16 +20,15 @@ from app.models import (
     VenvUpdate,
     Venv_Package,
 )
-from app import utils
+from app.pagination import PaginationDep, paginate
+from app import venvs
 
 
 router = APIRouter()
 
 
 @router.post("", response_model=VenvPublicWithJournal)
-def create_venv(
-    *, session: SessionDep, background_tasks: BackgroundTasks, venv: VenvCreate
-):
+def create_venv(*, session: SessionDep, venv: VenvCreate):
     statement = select(Venv).where(Venv.name == venv.name)
     db_venv = session.exec(statement).first()
     if db_venv:
@@ -35,35 +38,47 @@ def create_venv(
         )
     db_venv = Venv.model_validate(venv)
     session.add(db_venv)
-    db_journal_id = utils.create_journal(
-        session=session, journal=(JournalCreate(unit_id=db_venv.id))
-    )
-    background_tasks.add_task(
-        utils.run_ansible_playbook,
+    db_job = executor.submit(
         session=session,
-        playbook="app/playbooks/venv.yml",
-        options={
-            "extra_vars": {
-                "venv_directory": str(
-                    Path(settings.venv_dir).resolve() / str(db_venv.id)
-                ),
+        job=JobCreate(
+            kind="venv",
+            options={
+                "extra_vars": {
+                    "venv_directory": str(
+                        Path(settings.venv_dir).resolve() / str(db_venv.id)
+                    ),
+                },
+                "inventory": "localhost,",
             },
-            "inventory": "localhost,",
-            "tags": "create",
-        },
-        journal_id=db_journal_id,
+            playbook="app/playbooks/venv.yml",
+            tags="create",
+            unit_id=db_venv.id,
+        ),
     )
     session.commit()
     session.refresh(db_venv)
     db_venv_journal = VenvPublicWithJournal(
-        name=db_venv.name, id=db_venv.id, journal_id=db_journal_id
+        name=db_venv.name, id=db_venv.id, journal_id=db_job.journal_id
     )
     return db_venv_journal
 
 
 @router.get("", response_model=list[VenvPublic])
-def read_venv(*, session: SessionDep):
-    venvs = session.exec(select(Venv)).all()
+def read_venv(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    name: str | None = None,
+):
+    venvs = paginate(
+        session=session,
+        response=response,
+        model=Venv,
+        pagination=pagination,
+        sorts=["id", "name"],
+        filters={"name": name},
+    )
     return venvs
 
 
@@ -96,9 +111,7 @@ def update_venv(*, session: SessionDep, venv_id: uuid.UUID, venv: VenvUpdate):
 
 
 @router.delete("/{venv_id}")
-def delete_venv(
-    *, session: SessionDep, background_tasks: BackgroundTasks, venv_id: uuid.UUID
-):
+def delete_venv(*, session: SessionDep, venv_id: uuid.UUID):
     db_venv = session.get(Venv, venv_id)
     if not db_venv:
         raise HTTPException(
@@ -124,32 +137,29 @@ def delete_venv(
             detail=links_repositories_detail,
         )
     session.delete(db_venv)
-    db_journal_id = utils.create_journal(
-        session=session, journal=(JournalCreate(unit_id=db_venv.id))
-    )
-    background_tasks.add_task(
-        utils.run_ansible_playbook,
+    db_job = executor.submit(
         session=session,
-        playbook="app/playbooks/venv.yml",
-        options={
-            "extra_vars": {
-                "venv_directory": str(
-                    Path(settings.venv_dir).resolve() / str(db_venv.id)
-                ),
+        job=JobCreate(
+            kind="venv",
+            options={
+                "extra_vars": {
+                    "venv_directory": str(
+                        Path(settings.venv_dir).resolve() / str(db_venv.id)
+                    ),
+                },
+                "inventory": "localhost,",
             },
-            "inventory": "localhost,",
-            "tags": "delete",
-        },
-        journal_id=db_journal_id,
+            playbook="app/playbooks/venv.yml",
+            tags="delete",
+            unit_id=db_venv.id,
+        ),
     )
     session.commit()
-    return {"ok": True, "journal_id": db_journal_id}
+    return {"ok": True, "journal_id": db_job.journal_id}
 
 
 @router.post("/{venv_id}/install")
-def install_venv_by_id(
-    *, session: SessionDep, background_tasks: BackgroundTasks, venv_id: uuid.UUID
-):
+def install_venv_by_id(*, session: SessionDep, venv_id: uuid.UUID):
     db_venv = session.get(Venv, venv_id)
     if not db_venv:
         raise HTTPException(
@@ -169,54 +179,132 @@ def install_venv_by_id(
             db_venv_packages.append(f"{item.name}=={item.version}")
         else:
             db_venv_packages.append(f"{item.name}")
-    db_journal_id = utils.create_journal(
-        session=session, journal=(JournalCreate(unit_id=db_venv.id))
-    )
-    background_tasks.add_task(
-        utils.run_ansible_playbook,
+    db_job = executor.submit(
         session=session,
-        playbook="app/playbooks/venv.yml",
-        options={
-            "extra_vars": {
-                "venv_directory": str(
-                    Path(settings.venv_dir).resolve() / str(db_venv.id)
-                ),
-                "venv_package": db_venv_packages,
+        job=JobCreate(
+            kind="venv",
+            options={
+                "extra_vars": {
+                    "venv_directory": str(
+                        Path(settings.venv_dir).resolve() / str(db_venv.id)
+                    ),
+                    "venv_compile": settings.venv_compile,
+                    "venv_package": db_venv_packages,
+                    "wheelhouse_directory": str(
+                        Path(settings.wheelhouse_dir).resolve()
+                    ),
+                    "wheelhouse_offline": settings.wheelhouse_offline,
+                },
+                "inventory": "localhost,",
             },
-            "inventory": "localhost,",
-            "tags": "install",
-        },
-        journal_id=db_journal_id,
+            playbook="app/playbooks/venv.yml",
+            tags="install",
+            unit_id=db_venv.id,
+        ),
     )
-    return {"ok": True, "journal_id": db_journal_id}
+    return {"ok": True, "journal_id": db_job.journal_id}
 
 
 @router.post("/{venv_id}/uninstall")
-def uninstall_venv_by_id(
-    *, session: SessionDep, background_tasks: BackgroundTasks, venv_id: uuid.UUID
-):
+def uninstall_venv_by_id(*, session: SessionDep, venv_id: uuid.UUID):
+    db_venv = session.get(Venv, venv_id)
+    if not db_venv:
+        raise HTTPException(
+            status_code=404,
+            detail="The venv with this id does not exist in the system",
+        )
+    db_job = executor.submit(
+        session=session,
+        job=JobCreate(
+            kind="venv",
+            options={
+                "extra_vars": {
+                    "venv_directory": str(
+                        Path(settings.venv_dir).resolve() / str(db_venv.id)
+                    ),
+                },
+                "inventory": "localhost,",
+            },
+            playbook="app/playbooks/venv.yml",
+            tags="uninstall",
+            unit_id=db_venv.id,
+        ),
+    )
+    return {"ok": True, "journal_id": db_job.journal_id}
+
+
+@router.get("/{venv_id}/installed", response_model=list[Venv_InstalledPackagePublic])
+def read_venv_installed_by_id(*, session: SessionDep, venv_id: uuid.UUID):
     db_venv = session.get(Venv, venv_id)
     if not db_venv:
         raise HTTPException(
             status_code=404,
             detail="The venv with this id does not exist in the system",
         )
-    db_journal_id = utils.create_journal(
-        session=session, journal=(JournalCreate(unit_id=db_venv.id))
+    return venvs.list_installed_packages(
+        str(Path(settings.venv_dir).resolve() / str(db_venv.id))
     )
-    background_tasks.add_task(
-        utils.run_ansible_playbook,
+
+
+@router.post("/{venv_id}/lock")
+def lock_venv_by_id(*, session: SessionDep, venv_id: uuid.UUID):
+    db_venv = session.get(Venv, venv_id)
+    if not db_venv:
+        raise HTTPException(
+            status_code=404,
+            detail="The venv with this id does not exist in the system",
+        )
+    statement = select(Venv_Package).where(Venv_Package.venv_id == venv_id)
+    db_venv_package = session.exec(statement).all()
+    if len(db_venv_package) == 0:
+        raise HTTPException(
+            status_code=404,
+            detail="The venv with this id does not have any packages to lock",
+        )
+    db_venv_packages = []
+    for item in db_venv_package:
+        if item.version is not None:
+            db_venv_packages.append(f"{item.name}=={item.version}")
+        else:
+            db_venv_packages.append(f"{item.name}")
+    db_job = executor.submit(
         session=session,
-        playbook="app/playbooks/venv.yml",
-        options={
-            "extra_vars": {
-                "venv_directory": str(
-                    Path(settings.venv_dir).resolve() / str(db_venv.id)
-                ),
+        job=JobCreate(
+            kind="venv",
+            options={
+                "extra_vars": {
+                    "venv_directory": str(
+                        Path(settings.venv_dir).resolve() / str(db_venv.id)
+                    ),
+                    "venv_package": db_venv_packages,
+                    "wheelhouse_directory": str(
+                        Path(settings.wheelhouse_dir).resolve()
+                    ),
+                    "wheelhouse_offline": settings.wheelhouse_offline,
+                },
+                "inventory": "localhost,",
             },
-            "inventory": "localhost,",
-            "tags": "uninstall",
-        },
-        journal_id=db_journal_id,
+            playbook="app/playbooks/venv.yml",
+            tags="lock",
+            unit_id=db_venv.id,
+        ),
     )
-    return {"ok": True, "journal_id": db_journal_id}
+    return {"ok": True, "journal_id": db_job.journal_id}
+
+
+@router.get("/{venv_id}/lock", response_model=Venv_LockPublic)
+def read_venv_lock_by_id(*, session: SessionDep, venv_id: uuid.UUID):
+    db_venv = session.get(Venv, venv_id)
+    if not db_venv:
+        raise HTTPException(
+            status_code=404,
+            detail="The venv with this id does not exist in the system",
+        )
+    statement = select(Venv_Lock).where(Venv_Lock.venv_id == venv_id)
+    db_venv_lock = session.exec(statement).first()
+    if not db_venv_lock:
+        raise HTTPException(
+            status_code=404,
+            detail="The venv with this id does not have a lock",
+        )
+    return db_venv_lock
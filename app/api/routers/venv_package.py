@@ -1,6 +1,6 @@
 import uuid
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from sqlmodel import select
 
 from app.database import SessionDep
@@ -12,6 +12,7 @@ from app.models import (
     Venv_PackagePublicWithVenv,
     Venv_PackageUpdate,
 )
+from app.pagination import PaginationDep, paginate
 
 router = APIRouter()
 
@@ -43,8 +44,22 @@ def create_venv_package(*, session: SessionDep, venv_package: Venv_PackageCreate
 
 
 @router.get("", response_model=list[Venv_PackagePublic])
-def read_venv_package(*, session: SessionDep):
-    venv_packages = session.exec(select(Venv_Package)).all()
+def read_venv_package(
+    *,
+    session: SessionDep,
+    response: Response,
+    pagination: PaginationDep,
+    name: str | None = None,
+    venv_id: uuid.UUID | None = None,
+):
+    venv_packages = paginate(
+        session=session,
+        response=response,
+        model=Venv_Package,
+        pagination=pagination,
+        sorts=["id", "name"],
+        filters={"name": name, "venv_id": venv_id},
+    )
     return venv_packages
 
 
@@ -0,0 +1,61 @@
+import asyncio
+import threading
+import uuid
+
+
+class Subscription:
+    def __init__(self, *, maxsize: int) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=maxsize)
+        self.lagged = False
+
+    def put(self, event: dict) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lagged = True
+
+
+class Broker:
+    """Fan out the events of each journal to the subscribers of that journal.
+
+    Events are published from any thread and delivered to the event loop of
+    every subscriber. A subscriber that does not keep up is marked as lagged
+    instead of blocking the publisher, and should resynchronize from the
+    database.
+    """
+
+    def __init__(self, *, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._subscriptions: dict[uuid.UUID, set[Subscription]] = {}
+
+    def subscribe(self, journal_id: uuid.UUID) -> Subscription:
+        subscription = Subscription(maxsize=self.maxsize)
+        with self._lock:
+            self._subscriptions.setdefault(journal_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, journal_id: uuid.UUID, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscriptions.get(journal_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[journal_id]
+
+    def subscribed(self, journal_id: uuid.UUID) -> bool:
+        with self._lock:
+            return journal_id in self._subscriptions
+
+    def publish(self, journal_id: uuid.UUID, event: dict) -> None:
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(journal_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                self.unsubscribe(journal_id, subscription)
+
+
+broker = Broker()
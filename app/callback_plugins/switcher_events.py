@@ -0,0 +1,93 @@
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase  # type: ignore[import-untyped]
+
+DOCUMENTATION = """
+    name: switcher_events
+    type: notification
+    short_description: write task events as JSON lines for switcher
+    description:
+      - Writes one JSON object per task start and task result to the file
+        descriptor given in the SWITCHER_EVENTS_FD environment variable.
+    requirements:
+      - the SWITCHER_EVENTS_FD environment variable
+"""
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "notification"
+    CALLBACK_NAME = "switcher_events"
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super().__init__()
+        fd = os.environ.get("SWITCHER_EVENTS_FD")
+        self._file = os.fdopen(int(fd), "w", buffering=1) if fd else None
+        self._started = {}
+
+    def _emit(self, event):
+        if self._file is not None:
+            self._file.write(json.dumps(event, default=str) + "\n")
+
+    def _included_item(self, task):
+        variables = task.get_vars()
+        item = variables.get(variables.get("ansible_loop_var", "item"))
+        if isinstance(item, dict):
+            return item.get("switcher_item")
+        return None
+
+    def _result(self, result, status, item=False):
+        key = (result._host.get_name(), result._task._uuid)
+        finished_at = time.time()
+        started_at = self._started.get(key, finished_at)
+        if item:
+            self._started[key] = finished_at
+        self._emit(
+            {
+                "action": result._task.action,
+                "changed": bool(result._result.get("changed", False)),
+                "duration": finished_at - started_at,
+                "finished_at": finished_at,
+                "host": result._host.get_name(),
+                "item": (
+                    self._get_item_label(result._result)
+                    if item
+                    else self._included_item(result._task)
+                ),
+                "msg": (
+                    result._result.get("msg")
+                    if status in ("failed", "unreachable")
+                    else None
+                ),
+                "started_at": started_at,
+                "status": status,
+                "task": result._task.get_name(),
+            }
+        )
+
+    def v2_runner_on_start(self, host, task):
+        self._started[(host.get_name(), task._uuid)] = time.time()
+
+    def v2_runner_on_ok(self, result):
+        self._result(result, "ok")
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._result(result, "ignored" if ignore_errors else "failed")
+
+    def v2_runner_on_skipped(self, result):
+        self._result(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result):
+        self._result(result, "unreachable")
+
+    def v2_runner_item_on_ok(self, result):
+        self._result(result, "ok", item=True)
+
+    def v2_runner_item_on_failed(self, result):
+        self._result(result, "failed", item=True)
+
+    def v2_runner_item_on_skipped(self, result):
+        self._result(result, "skipped", item=True)
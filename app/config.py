@@ -34,6 +34,31 @@ class Settings(BaseSettings):
     def repository_dir(self) -> str:
         return f"{self.data_dir}/repository"
 
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def venv_pool_dir(self) -> str:
+        return f"{self.data_dir}/venv_pool"
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def venv_store_dir(self) -> str:
+        return f"{self.data_dir}/venv_store"
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def venv_template_dir(self) -> str:
+        return f"{self.data_dir}/venv_template"
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def wheelhouse_dir(self) -> str:
+        return f"{self.data_dir}/wheelhouse"
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def repository_mirror_dir(self) -> str:
+        return f"{self.data_dir}/repository_mirror"
+
     @computed_field  # type: ignore[prop-decorator]
     @property
     def db_dir(self) -> str | None:
@@ -64,6 +89,51 @@ class Settings(BaseSettings):
 
     token_expire_minutes: int = 60
 
+    journal_flush_lines: int = 500
+    journal_flush_interval: float = 1.0
+    journal_stream_interval: float = 5.0
+    journal_tasks: bool = True
+
+    executor_workers: int = os.cpu_count() or 1
+    executor_venv_workers: int | None = None
+    executor_repository_workers: int | None = None
+    executor_poll_interval: float = 1.0
+    executor_embedded: bool = True
+    executor_native_venv: bool = True
+    executor_batch_size: int = 100
+
+    job_heartbeat_interval: float = 10.0
+    job_lease_seconds: int = 60
+    job_max_attempts: int = 3
+    job_timeout: float | None = None
+    job_venv_timeout: float | None = None
+    job_repository_timeout: float | None = None
+    job_kill_timeout: float = 10.0
+
+    @model_validator(mode="after")
+    def _verify_job_lease(self) -> Self:
+        if self.job_lease_seconds <= self.job_heartbeat_interval:
+            raise ValueError(
+                "JOB_LEASE_SECONDS must be greater than JOB_HEARTBEAT_INTERVAL."
+            )
+        return self
+
+    repository_index_interval: float = 300.0
+    repository_mirror: bool = True
+    repository_resolve_interval: float = 60.0
+    repository_resolve_timeout: float = 60.0
+
+    venv_compile: bool = True
+    venv_dedup_interval: float = 3600.0
+    venv_pool_size: int = 2
+    venv_template_max: int = 8
+
+    wheelhouse_max_size: int = 10 * 1024**3
+    wheelhouse_offline: bool = False
+
+    pagination_limit: int = 100
+    pagination_count_limit: int = 10000
+
 
 settings = Settings()
 
@@ -73,6 +143,16 @@ def create_directories():
 
     os.makedirs(f"{settings.repository_dir}", exist_ok=True)
 
+    os.makedirs(f"{settings.repository_mirror_dir}", exist_ok=True)
+
     os.makedirs(f"{settings.venv_dir}", exist_ok=True)
+
+    os.makedirs(f"{settings.venv_pool_dir}", exist_ok=True)
+
+    os.makedirs(f"{settings.venv_store_dir}", exist_ok=True)
+
+    os.makedirs(f"{settings.venv_template_dir}", exist_ok=True)
+
+    os.makedirs(f"{settings.wheelhouse_dir}", exist_ok=True)
     if settings.db_dir is not None:
         os.makedirs(f"{settings.db_dir}", exist_ok=True)
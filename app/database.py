@@ -1,7 +1,8 @@
 from typing import Annotated
 
 from fastapi import Depends
-from sqlmodel import SQLModel, Session, create_engine, text
+from sqlalchemy import Connection, Table, inspect
+from sqlmodel import CheckConstraint, SQLModel, Session, create_engine, text
 
 from app.config import settings
 
@@ -11,11 +12,67 @@ engine = create_engine(
 )
 
 
+def upgrade_sqlite_table(connection: Connection, table: Table) -> None:
+    """Bring an existing SQLite table up to date with its model.
+
+    Missing nullable columns are added and missing indexes created. The table
+    is rebuilt when one of its CHECK constraints changed, since SQLite cannot
+    alter constraints.
+    """
+    columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+    for column in table.columns:
+        if column.name in columns:
+            continue
+        if not column.nullable and column.server_default is None:
+            raise RuntimeError(
+                f"The database table {table.name} has no column {column.name},"
+                " which can not be added to existing rows; recreate the database"
+            )
+        column_type = column.type.compile(dialect=connection.dialect)
+        connection.execute(
+            text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+        )
+    sql = connection.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {"name": table.name},
+    ).scalar_one()
+    if all(
+        str(constraint.sqltext) in sql
+        for constraint in table.constraints
+        if isinstance(constraint, CheckConstraint)
+    ):
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+        return
+    names = ", ".join(f'"{column.name}"' for column in table.columns)
+    connection.execute(text("PRAGMA legacy_alter_table=ON"))
+    connection.execute(text(f'ALTER TABLE "{table.name}" RENAME TO "_{table.name}"'))
+    for index in inspect(connection).get_indexes(f"_{table.name}"):
+        connection.execute(text(f'DROP INDEX "{index["name"]}"'))
+    table.create(connection)
+    connection.execute(
+        text(
+            f'INSERT INTO "{table.name}" ({names}) SELECT {names} FROM "_{table.name}"'
+        )
+    )
+    connection.execute(text(f'DROP TABLE "_{table.name}"'))
+    connection.execute(text("PRAGMA legacy_alter_table=OFF"))
+
+
 def create_db_and_tables():
+    if settings.database_type == "sqlite":
+        with engine.connect() as connection:
+            connection.execute(text("PRAGMA foreign_keys=OFF"))
+            tables = set(inspect(connection).get_table_names())
+            for table in SQLModel.metadata.sorted_tables:
+                if table.name in tables:
+                    upgrade_sqlite_table(connection, table)
+            connection.commit()
     SQLModel.metadata.create_all(engine)
     if settings.database_type == "sqlite":
         with engine.connect() as connection:
             connection.execute(text("PRAGMA foreign_keys=ON"))
+            connection.execute(text("PRAGMA journal_mode=WAL"))
 
 
 def get_session():
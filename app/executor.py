@@ -0,0 +1,1228 @@
+import asyncio
+import contextlib
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy.orm import aliased
+from sqlmodel import (
+    Session,
+    col,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    tuple_,
+    update,
+)
+
+from app.broker import broker
+from app.config import settings
+from app.database import engine
+from app.models import (
+    ActiveEnum,
+    Job,
+    JobCreate,
+    JobStateEnum,
+    Journal,
+    JournalCreate,
+    JournalUpdate,
+    Repository,
+    Repository_Playbook,
+    Venv,
+    Venv_Lock,
+)
+from app import repositories, utils, venvs
+
+logger = logging.getLogger("uvicorn")
+
+
+def read_venv_lock(venv_id: uuid.UUID) -> Venv_Lock | None:
+    with Session(engine) as session:
+        statement = select(Venv_Lock).where(Venv_Lock.venv_id == venv_id)
+        return session.exec(statement).first()
+
+
+def save_venv_lock(*, venv_id: uuid.UUID, packages: list[str], report: str) -> None:
+    with Session(engine) as session:
+        statement = select(Venv_Lock).where(Venv_Lock.venv_id == venv_id)
+        db_venv_lock = session.exec(statement).first()
+        if not db_venv_lock:
+            db_venv_lock = Venv_Lock(key="", venv_id=venv_id)
+        db_venv_lock.created_at = datetime.utcnow()
+        db_venv_lock.key = venvs.venv_packages_key(packages)
+        db_venv_lock.packages = venvs.read_lock_report(report)
+        session.add(db_venv_lock)
+        session.commit()
+
+
+async def prepare_venv_job(*, job: Job, temporary: str) -> tuple[str, dict]:
+    """Return the operation of a venv job and the options of its playbook.
+
+    An install is reduced to the packages to change in the venv, pinned with
+    hashes by the lock of the venv when the lock was resolved from the same
+    packages. It becomes the reconcile operation when there is nothing to
+    change, and the clone operation when the packages are pinned and have a
+    template, with the options of the install to run when the clone fails.
+    The template of a locked venv is the one of its locked packages, which
+    `venv_template` holds.
+    """
+    extra_vars = job.options["extra_vars"]
+    if job.tags == "lock":
+        extra_vars = {
+            **extra_vars,
+            "venv_lock_report": os.path.join(temporary, "report.json"),
+        }
+        return job.tags, {**job.options, "extra_vars": extra_vars}
+    if job.tags != "install":
+        return job.tags, job.options
+    packages = extra_vars["venv_package"]
+    db_venv_lock = await asyncio.to_thread(read_venv_lock, job.unit_id)
+    locked = None
+    if db_venv_lock and db_venv_lock.key == venvs.venv_packages_key(packages):
+        locked = {
+            venvs.canonicalize_name(package["name"]): package
+            for package in db_venv_lock.packages
+        }
+        packages = [
+            f"{package['name']}=={package['version']}" for package in locked.values()
+        ]
+    install, remove = await asyncio.to_thread(
+        venvs.venv_package_delta, extra_vars["venv_directory"], packages=packages
+    )
+    if not install and not remove:
+        return "reconcile", job.options
+    extra_vars = {
+        **extra_vars,
+        "venv_package": install,
+        "venv_package_absent": remove,
+        "venv_template": packages,
+    }
+    if locked is not None:
+        requirements = os.path.join(temporary, "requirements.txt")
+        extra_vars["venv_require_hashes"] = venvs.write_lock_requirements(
+            requirements,
+            packages=[
+                locked[venvs.canonicalize_name(package.partition("==")[0])]
+                for package in install
+            ],
+        )
+        extra_vars["venv_requirements"] = requirements
+    if (
+        settings.executor_native_venv
+        and venvs.venv_packages_pinned(packages)
+        and os.path.isdir(
+            Path(settings.venv_template_dir).resolve()
+            / venvs.venv_packages_key(packages)
+        )
+    ):
+        return "clone", {**job.options, "extra_vars": extra_vars}
+    return job.tags, {**job.options, "extra_vars": extra_vars}
+
+
+def read_repository_commit(repository_id: uuid.UUID) -> str | None:
+    with Session(engine) as session:
+        statement = select(Repository.commit).where(Repository.id == repository_id)
+        return session.exec(statement).first()
+
+
+async def prepare_repository_job(*, job: Job) -> tuple[str, str]:
+    """Return the operation of a repository job and the commit to install.
+
+    An install becomes the reconcile operation when the checkout of the
+    repository is already at the commit its ref resolves to in the remote,
+    and the commit recorded by the last install.
+    """
+    if job.tags != "install":
+        return job.tags, ""
+    installed = await asyncio.to_thread(read_repository_commit, job.unit_id)
+    if installed is None:
+        return job.tags, ""
+    repository = job.options["extra_vars"]["repositories"][0]
+    commit = await asyncio.to_thread(
+        repositories.resolve_remote_ref, repository["url"], ref=repository.get("ref")
+    )
+    if commit is None or commit != installed:
+        return job.tags, ""
+    if commit != await asyncio.to_thread(
+        repositories.head_commit, repository["directory"]
+    ):
+        return job.tags, ""
+    return "reconcile", commit
+
+
+async def reconcile_repository(*, job: Job, commit: str) -> ActiveEnum:
+    return await utils.run_task(
+        task=utils.repository_tasks["reconcile"],
+        journal_id=job.journal_id,
+        function=lambda: ("git ls-remote", False),
+        message=f"The repository is already at commit {commit}",
+    )
+
+
+def save_repository_commit(*, job: Job) -> None:
+    commit = repositories.head_commit(job.options["extra_vars"]["repository_directory"])
+    with Session(engine) as session:
+        session.execute(
+            update(Repository)
+            .where(col(Repository.id) == job.unit_id)
+            .values(commit=commit)
+        )
+        session.commit()
+
+
+def save_repository_playbooks(
+    *, repository_id: uuid.UUID, commit: str | None, playbooks: list[dict]
+) -> None:
+    """Replace the playbooks of a repository with those of its checkout at `commit`.
+
+    Nothing is saved when the commit of the repository changed meanwhile.
+    """
+    with Session(engine) as session:
+        result = session.connection().execute(
+            update(Repository)
+            .where(
+                col(Repository.id) == repository_id,
+                col(Repository.commit).is_not_distinct_from(commit),
+            )
+            .values(indexed_commit=commit)
+        )
+        if result.rowcount != 1:
+            session.rollback()
+            return
+        session.execute(
+            delete(Repository_Playbook).where(
+                col(Repository_Playbook.repository_id) == repository_id
+            )
+        )
+        if playbooks:
+            session.execute(
+                insert(Repository_Playbook),
+                [
+                    {**playbook, "repository_id": repository_id}
+                    for playbook in playbooks
+                ],
+            )
+        session.commit()
+
+
+async def run_batch(
+    *,
+    jobs: list[Job],
+    cancel: asyncio.Event | None = None,
+    timeout: float | None = None,
+) -> dict[uuid.UUID, ActiveEnum]:
+    """Run the repository install jobs of a batch in one ansible-playbook process.
+
+    Jobs with nothing to install are reconciled on their own first. The
+    process installs the repositories of the other jobs, labelled with their
+    job ids, and its output goes to the journal of the batch, which is only
+    marked done when at most one job is left to install. Each job gets
+    the task events of its repository in its own journal, and succeeds when
+    its repository was installed. Returns the state of each job.
+    """
+    actives = {}
+    pending = []
+    for job in jobs:
+        operation, commit = await prepare_repository_job(job=job)
+        if operation == "reconcile":
+            actives[job.id] = await reconcile_repository(job=job, commit=commit)
+        else:
+            pending.append(job)
+    batch = uuid.UUID(jobs[0].options["batch"])
+    if len(pending) == 1:
+        actives[pending[0].id] = await run_job(
+            job=pending[0], cancel=cancel, timeout=timeout
+        )
+    if len(pending) <= 1:
+        async with utils.JournalWriter(journal_id=batch) as writer:
+            await writer.write_async(
+                "The repositories of the batch were installed in their own journals"
+            )
+        await utils.update_journal_async(
+            journal_id=batch,
+            journal=(JournalUpdate(active="inactive", finished_at=datetime.utcnow())),
+        )
+        return actives
+    started = time.monotonic()
+    for job in pending:
+        await utils.update_journal_async(
+            journal_id=job.journal_id,
+            journal=(JournalUpdate(active="activating")),
+        )
+        await utils.update_journal_async(
+            journal_id=job.journal_id,
+            journal=(JournalUpdate(active="active", started_at=datetime.utcnow())),
+        )
+    async with contextlib.AsyncExitStack() as stack:
+        writers = {
+            str(job.id): await stack.enter_async_context(
+                utils.JournalWriter(journal_id=job.journal_id)
+            )
+            for job in pending
+        }
+        active = await utils.run_ansible_playbook(
+            venv_directory=pending[0].venv_directory,
+            playbook=pending[0].playbook,
+            options={
+                **pending[0].options,
+                "extra_vars": {
+                    "repositories": [
+                        {**repository, "switcher_item": str(job.id)}
+                        for job in pending
+                        for repository in job.options["extra_vars"]["repositories"]
+                    ]
+                },
+                "tags": "install",
+            },
+            journal_id=batch,
+            cancel=cancel,
+            timeout=timeout,
+            items=writers,
+        )
+        for job in pending:
+            writer = writers[str(job.id)]
+            if writer.results.get(utils.repository_tasks["install"]) == "ok":
+                actives[job.id] = ActiveEnum.inactive
+                result = "was installed"
+            elif active == ActiveEnum.cancelled:
+                actives[job.id] = active
+                result = "install was cancelled"
+            elif active == ActiveEnum.timeout:
+                actives[job.id] = active
+                result = "install timed out"
+            else:
+                actives[job.id] = ActiveEnum.failed
+                result = "install failed"
+            await writer.write_async(
+                f"The repository {result} in the ansible-playbook process"
+                f" of the batch journal {batch}"
+            )
+    for job in pending:
+        await utils.update_journal_async(
+            journal_id=job.journal_id,
+            journal=(
+                JournalUpdate(
+                    active=actives[job.id],
+                    finished_at=datetime.utcnow(),
+                    wall_time=time.monotonic() - started,
+                )
+            ),
+        )
+        if actives[job.id] == ActiveEnum.inactive:
+            await asyncio.to_thread(save_repository_commit, job=job)
+    return actives
+
+
+async def run_job(
+    *,
+    job: Job,
+    cancel: asyncio.Event | None = None,
+    timeout: float | None = None,
+) -> ActiveEnum:
+    with tempfile.TemporaryDirectory(prefix="switcher-") as temporary:
+        operation, options = job.tags, job.options
+        if job.kind == "venv":
+            operation, options = await prepare_venv_job(job=job, temporary=temporary)
+            if operation == "clone":
+                active = await utils.run_venv(
+                    operation=operation,
+                    venv_directory=options["extra_vars"]["venv_directory"],
+                    journal_id=job.journal_id,
+                    packages=options["extra_vars"]["venv_template"],
+                )
+                if active == ActiveEnum.inactive:
+                    return active
+                operation = job.tags
+            if operation in ("dedup", "prune", "reconcile") or (
+                settings.executor_native_venv and operation in utils.venv_tasks
+            ):
+                return await utils.run_venv(
+                    operation=operation,
+                    venv_directory=options["extra_vars"]["venv_directory"],
+                    journal_id=job.journal_id,
+                    packages=options["extra_vars"].get("venv_template"),
+                )
+        elif job.kind == "repository":
+            operation, commit = await prepare_repository_job(job=job)
+            if operation == "reconcile":
+                return await reconcile_repository(job=job, commit=commit)
+        extra_vars = job.options.get("extra_vars", {})
+        async with contextlib.AsyncExitStack() as stack:
+            if job.kind == "venv" and "wheelhouse_directory" in extra_vars:
+                await stack.enter_async_context(
+                    utils.share_wheelhouse(extra_vars["wheelhouse_directory"])
+                )
+            active = await utils.run_ansible_playbook(
+                venv_directory=job.venv_directory,
+                playbook=job.playbook,
+                options={**options, "tags": job.tags},
+                journal_id=job.journal_id,
+                cancel=cancel,
+                timeout=timeout,
+            )
+        if job.kind == "venv" and active == ActiveEnum.inactive:
+            if job.tags == "lock":
+                await asyncio.to_thread(
+                    save_venv_lock,
+                    venv_id=job.unit_id,
+                    packages=extra_vars["venv_package"],
+                    report=options["extra_vars"]["venv_lock_report"],
+                )
+            elif job.tags == "install" and settings.executor_native_venv:
+                await asyncio.to_thread(
+                    venvs.save_venv_template,
+                    extra_vars["venv_directory"],
+                    packages=options["extra_vars"]["venv_template"],
+                )
+        elif job.kind == "repository" and active == ActiveEnum.inactive:
+            if job.tags in ("install", "uninstall"):
+                await asyncio.to_thread(save_repository_commit, job=job)
+    wheelhouse_directory = extra_vars.get("wheelhouse_directory")
+    if wheelhouse_directory is not None:
+        removed = await asyncio.to_thread(
+            utils.prune_wheelhouse,
+            wheelhouse_directory=wheelhouse_directory,
+            max_size=settings.wheelhouse_max_size,
+        )
+        if removed:
+            logger.info(f"The wheelhouse pruned {len(removed)} wheels")
+    return active
+
+
+def unit_conditions() -> tuple:
+    """Return the conditions a queued job must not meet to be claimed.
+
+    The unit of the job has a running job, or an older queued job.
+    """
+    previous = aliased(Job)
+    running_unit = (
+        select(previous.id)
+        .where(
+            previous.unit_id == Job.unit_id,
+            col(previous.state) == JobStateEnum.running,
+        )
+        .exists()
+    )
+    queued_before = (
+        select(previous.id)
+        .where(
+            previous.unit_id == Job.unit_id,
+            col(previous.state) == JobStateEnum.queued,
+            tuple_(previous.created_at, previous.id) < tuple_(Job.created_at, Job.id),
+        )
+        .exists()
+    )
+    return running_unit, queued_before
+
+
+class Executor:
+    """Run the jobs stored in the job table on a single event loop thread.
+
+    Queued jobs are claimed in FIFO order, and the jobs of one unit run one
+    at a time in the order they were queued. `workers` caps the number of jobs
+    running at once and `limits` caps the number of running jobs of each kind;
+    a job whose kind is at its cap is skipped until a slot of that kind frees
+    up, without blocking the jobs of other kinds queued behind it.
+
+    Several executors, in the API process and in `app.worker` processes, can
+    share the job table: a job is claimed with a conditional update, so only
+    one of them gets it. A claimed job holds a lease that is renewed by a
+    heartbeat while it runs. Jobs whose lease expired, because the process
+    running them went away, are requeued by `recover` until they reach
+    `job_max_attempts`. A run is fenced by its claim, the executor name and
+    attempt number it was claimed with: a run whose lease renewal fails is
+    stopped, and its final state is only saved while the claim still holds.
+
+    Jobs are coroutines supervising their ansible-playbook subprocess, so the
+    number of threads used does not grow with `workers`. `timeouts` caps the
+    run time of the jobs of each kind, and the jobs flagged by `cancel`
+    are stopped on the next poll of the executor running them.
+    """
+
+    def __init__(
+        self,
+        *,
+        workers: int,
+        limits: dict[str, int],
+        timeouts: dict[str, float | None] | None = None,
+    ) -> None:
+        self.workers = workers
+        self.limits = limits
+        self.timeouts = timeouts or {}
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._running: dict[tuple[uuid.UUID, int], str] = {}
+        self._runs: dict[tuple[uuid.UUID, int], str] = {}
+        self._cancels: dict[tuple[uuid.UUID, int], asyncio.Event] = {}
+        self._index: asyncio.Event | None = None
+        self._thread: threading.Thread | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._stopping = False
+
+    def start(self) -> None:
+        self._stopping = False
+        started = threading.Event()
+        self._thread = threading.Thread(
+            target=asyncio.run,
+            args=(self._main(started),),
+            name="executor",
+            daemon=True,
+        )
+        self._thread.start()
+        started.wait()
+
+    def shutdown(self) -> None:
+        self._stopping = True
+        self.wakeup()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wakeup(self) -> None:
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and wakeup is not None:
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                pass
+
+    def submit(self, *, session: Session, job: JobCreate) -> Job:
+        """Queue `job` with a new journal for its unit.
+
+        When the last job of the unit is still queued and has the same kind,
+        playbook, tags, options and venv, that job is returned instead, so
+        repeated requests share its journal instead of running again.
+        """
+        db_job = self._queue(session=session, job=job)
+        session.commit()
+        session.refresh(db_job)
+        self.wakeup()
+        return db_job
+
+    def submit_batch(
+        self, *, session: Session, unit_id: uuid.UUID, jobs: list[JobCreate]
+    ) -> tuple[uuid.UUID | None, list[Job]]:
+        """Queue `jobs` as one batch and return its journal and their jobs.
+
+        The jobs are queued together, each with its own journal as with
+        `submit`. Jobs of a batch that can be claimed at the same time run in
+        a single ansible-playbook process, whose output goes to the journal of
+        the batch created for `unit_id`, and the events of each job are also
+        written to its own journal. A single job is submitted on its own,
+        without a batch journal.
+        """
+        if len(jobs) == 1:
+            return None, [self.submit(session=session, job=jobs[0])]
+        journal_id = utils.create_journal(
+            session=session, journal=(JournalCreate(unit_id=unit_id))
+        )
+        db_jobs = [
+            self._queue(
+                session=session,
+                job=job.model_copy(
+                    update={"options": {**job.options, "batch": str(journal_id)}}
+                ),
+            )
+            for job in jobs
+        ]
+        session.commit()
+        for db_job in db_jobs:
+            session.refresh(db_job)
+        self.wakeup()
+        return journal_id, db_jobs
+
+    def _queue(self, *, session: Session, job: JobCreate) -> Job:
+        statement = (
+            select(Job)
+            .where(Job.unit_id == job.unit_id)
+            .order_by(col(Job.created_at).desc(), col(Job.id).desc())
+            .limit(1)
+        )
+        db_job = session.exec(statement).first()
+        if db_job is not None and db_job.state == JobStateEnum.queued:
+            queued = db_job.model_dump(include=set(JobCreate.model_fields))
+            requested = job.model_dump()
+            for dump in (queued, requested):
+                dump["options"] = {
+                    key: value
+                    for key, value in dump["options"].items()
+                    if key != "batch"
+                }
+            if queued == requested:
+                logger.info(f"The executor job {db_job.id} was requested again")
+                return db_job
+        db_journal = Journal.model_validate(JournalCreate(unit_id=job.unit_id))
+        session.add(db_journal)
+        session.flush()
+        db_job = Job.model_validate(job, update={"journal_id": db_journal.id})
+        session.add(db_job)
+        return db_job
+
+    def batched(self, *, session: Session, journal_id: uuid.UUID) -> bool:
+        """Return whether the running job of a journal shares its process.
+
+        The jobs of a batch claimed together run in one ansible-playbook
+        process, which can only be stopped for all of them, by cancelling the
+        journal of the batch.
+        """
+        statement = select(Job).where(
+            Job.journal_id == journal_id, col(Job.state) == JobStateEnum.running
+        )
+        db_job = session.exec(statement).first()
+        if db_job is None or db_job.options.get("batch") is None:
+            return False
+        statement = select(Job.id).where(
+            col(Job.id) != db_job.id,
+            col(Job.state) == JobStateEnum.running,
+            col(Job.options)["batch"].as_string() == db_job.options["batch"],
+        )
+        return session.exec(statement).first() is not None
+
+    def cancel(self, *, session: Session, journal_id: uuid.UUID) -> Job | None:
+        """Cancel the queued or running job of a journal.
+
+        A queued job is cancelled right away. A running job is flagged with
+        `cancel_requested_at`, and the executor running it stops its process
+        group on its next poll. The journal of a batch cancels every queued
+        or running job of the batch, and the first of them is returned, and is
+        itself cancelled when none of them was claimed yet.
+        Returns None when the journal has no queued or running job.
+        """
+        now = datetime.utcnow()
+        statement = (
+            select(Job)
+            .where(
+                or_(
+                    Job.journal_id == journal_id,
+                    col(Job.options)["batch"].as_string() == str(journal_id),
+                ),
+                col(Job.state).in_([JobStateEnum.queued, JobStateEnum.running]),
+            )
+            .order_by(col(Job.created_at), col(Job.id))
+        )
+        cancelled = None
+        for db_job in session.exec(statement).all():
+            result = session.connection().execute(
+                update(Job)
+                .where(col(Job.id) == db_job.id, col(Job.state) == JobStateEnum.queued)
+                .values(state=JobStateEnum.cancelled, finished_at=now)
+            )
+            session.commit()
+            if result.rowcount == 1:
+                utils.update_journal(
+                    session=session,
+                    journal_id=db_job.journal_id,
+                    journal=(JournalUpdate(active=ActiveEnum.cancelled)),
+                )
+                broker.publish(
+                    db_job.journal_id,
+                    {"event": "job", "state": JobStateEnum.cancelled},
+                )
+            else:
+                result = session.connection().execute(
+                    update(Job)
+                    .where(
+                        col(Job.id) == db_job.id, col(Job.state) == JobStateEnum.running
+                    )
+                    .values(cancel_requested_at=now)
+                )
+                session.commit()
+                if result.rowcount != 1:
+                    continue
+                self.wakeup()
+            session.refresh(db_job)
+            if cancelled is None:
+                cancelled = db_job
+        if cancelled is not None and cancelled.journal_id != journal_id:
+            result = session.connection().execute(
+                update(Journal)
+                .where(
+                    col(Journal.id) == journal_id,
+                    col(Journal.active) == ActiveEnum.inactive,
+                    col(Journal.started_at).is_(None),
+                )
+                .values(active=ActiveEnum.cancelled, finished_at=now)
+            )
+            session.commit()
+            if result.rowcount == 1:
+                broker.publish(
+                    journal_id, {"event": "state", "active": ActiveEnum.cancelled}
+                )
+        return cancelled
+
+    def recover(self) -> None:
+        now = datetime.utcnow()
+        with Session(engine) as session:
+            statement = select(Job).where(
+                col(Job.state) == JobStateEnum.running,
+                col(Job.lease_expires_at) < now,
+            )
+            for db_job in session.exec(statement).all():
+                values: dict
+                message = f"The job lease held by {db_job.claimed_by} expired"
+                if db_job.cancel_requested_at is not None:
+                    values = {"state": JobStateEnum.cancelled, "finished_at": now}
+                    active = ActiveEnum.cancelled
+                    message += ", cancelled as requested"
+                elif db_job.attempts < settings.job_max_attempts:
+                    values = {
+                        "state": JobStateEnum.queued,
+                        "claimed_at": None,
+                        "claimed_by": None,
+                        "heartbeat_at": None,
+                        "lease_expires_at": None,
+                    }
+                    active = ActiveEnum.activating
+                    message += (
+                        f", requeued after attempt {db_job.attempts}"
+                        f" of {settings.job_max_attempts}"
+                    )
+                else:
+                    values = {"state": JobStateEnum.failed, "finished_at": now}
+                    active = ActiveEnum.failed
+                    message += f", failed after {db_job.attempts} attempts"
+                result = session.connection().execute(
+                    update(Job)
+                    .where(
+                        col(Job.id) == db_job.id,
+                        col(Job.state) == JobStateEnum.running,
+                        col(Job.lease_expires_at) == db_job.lease_expires_at,
+                    )
+                    .values(**values)
+                )
+                session.commit()
+                if result.rowcount != 1:
+                    continue
+                logger.warning(f"The executor job {db_job.id}: {message}")
+                with utils.JournalWriter(
+                    session=session, journal_id=db_job.journal_id
+                ) as writer:
+                    writer.write(message)
+                utils.update_journal(
+                    session=session,
+                    journal_id=db_job.journal_id,
+                    journal=(JournalUpdate(active=active)),
+                )
+
+    def stats(self) -> dict:
+        with Session(engine) as session:
+            statement = (
+                select(Job.kind, Job.state, func.count())
+                .where(col(Job.state).in_([JobStateEnum.queued, JobStateEnum.running]))
+                .group_by(Job.kind, Job.state)
+            )
+            counts = session.exec(statement).all()
+        kinds = {
+            kind: {"limit": limit, "queued": 0, "running": 0}
+            for kind, limit in self.limits.items()
+        }
+        for kind, state, count in counts:
+            kinds.setdefault(kind, {"limit": self.workers, "queued": 0, "running": 0})[
+                JobStateEnum(state).value
+            ] = count
+        with self._lock:
+            local = [job_id for job_id, _ in self._running]
+        return {
+            "name": self.name,
+            "workers": self.workers,
+            "queued": sum(kind["queued"] for kind in kinds.values()),
+            "running": sum(kind["running"] for kind in kinds.values()),
+            "kinds": kinds,
+            "jobs": local,
+        }
+
+    def _claim(self) -> list[Job]:
+        """Claim the next queued job, with the queued jobs of its batch.
+
+        The journal of a batch is claimed with its first job, so the jobs of
+        a batch run together once. A job of a batch whose journal was already
+        claimed leaves the batch and runs on its own. Returns an empty list
+        when no job can be claimed. Jobs still running in this executor, from
+        a claim whose lease expired, are never claimed again by it.
+        """
+        running: dict[str, int] = {}
+        with self._lock:
+            for kind in self._runs.values():
+                running[kind] = running.get(kind, 0) + 1
+            local = [job_id for job_id, _ in self._running]
+        capped = [
+            kind
+            for kind, count in running.items()
+            if count >= self.limits.get(kind, self.workers)
+        ]
+        running_unit, queued_before = unit_conditions()
+        with Session(engine) as session:
+            statement = (
+                select(Job.id)
+                .where(
+                    col(Job.state) == JobStateEnum.queued,
+                    col(Job.kind).not_in(capped),
+                    col(Job.id).not_in(local),
+                    ~running_unit,
+                    ~queued_before,
+                )
+                .order_by(col(Job.created_at))
+                .limit(self.workers)
+            )
+            for job_id in session.exec(statement).all():
+                db_job = self._claim_job(session=session, job_id=job_id)
+                if db_job is None:
+                    continue
+                db_jobs = [db_job]
+                batch = db_job.options.get("batch")
+                if batch is not None and not self._claim_batch(
+                    session=session, batch=batch
+                ):
+                    db_job.options = {
+                        key: value
+                        for key, value in db_job.options.items()
+                        if key != "batch"
+                    }
+                    session.execute(
+                        update(Job)
+                        .where(col(Job.id) == db_job.id)
+                        .values(options=db_job.options)
+                    )
+                    session.commit()
+                elif batch is not None:
+                    statement = (
+                        select(Job.id)
+                        .where(
+                            col(Job.state) == JobStateEnum.queued,
+                            col(Job.options)["batch"].as_string() == batch,
+                            col(Job.id).not_in(local),
+                            ~running_unit,
+                            ~queued_before,
+                        )
+                        .order_by(col(Job.created_at))
+                        .limit(settings.executor_batch_size - 1)
+                    )
+                    for batch_job_id in session.exec(statement).all():
+                        db_batch_job = self._claim_job(
+                            session=session, job_id=batch_job_id
+                        )
+                        if db_batch_job is not None:
+                            db_jobs.append(db_batch_job)
+                with self._lock:
+                    self._runs[(db_job.id, db_job.attempts)] = db_job.kind
+                    for db_batch_job in db_jobs:
+                        self._running[(db_batch_job.id, db_batch_job.attempts)] = (
+                            db_batch_job.kind
+                        )
+                return db_jobs
+        return []
+
+    def _claim_batch(self, *, session: Session, batch: str) -> bool:
+        result = session.connection().execute(
+            update(Journal)
+            .where(
+                col(Journal.id) == uuid.UUID(batch),
+                col(Journal.active) == ActiveEnum.inactive,
+                col(Journal.started_at).is_(None),
+            )
+            .values(active=ActiveEnum.activating)
+        )
+        session.commit()
+        if result.rowcount != 1:
+            return False
+        broker.publish(
+            uuid.UUID(batch), {"event": "state", "active": ActiveEnum.activating}
+        )
+        return True
+
+    def _claim_job(self, *, session: Session, job_id: uuid.UUID) -> Job | None:
+        running_unit, _ = unit_conditions()
+        now = datetime.utcnow()
+        result = session.connection().execute(
+            update(Job)
+            .where(
+                col(Job.id) == job_id,
+                col(Job.state) == JobStateEnum.queued,
+                ~running_unit,
+            )
+            .values(
+                state=JobStateEnum.running,
+                attempts=col(Job.attempts) + 1,
+                claimed_at=now,
+                claimed_by=self.name,
+                heartbeat_at=now,
+                lease_expires_at=now + timedelta(seconds=settings.job_lease_seconds),
+            )
+        )
+        session.commit()
+        if result.rowcount != 1:
+            return None
+        db_job = session.get(Job, job_id)
+        if db_job:
+            session.expunge(db_job)
+        return db_job
+
+    async def _poll_cancels(self) -> None:
+        if not self._cancels:
+            return
+        job_ids = [job_id for job_id, _ in self._cancels]
+
+        def requested() -> list[tuple[uuid.UUID, int]]:
+            with Session(engine) as session:
+                statement = select(Job.id, Job.attempts).where(
+                    col(Job.id).in_(job_ids),
+                    col(Job.cancel_requested_at).is_not(None),
+                )
+                return [
+                    (job_id, attempts)
+                    for job_id, attempts in session.exec(statement).all()
+                ]
+
+        for claim in await asyncio.to_thread(requested):
+            cancel = self._cancels.get(claim)
+            if cancel is not None:
+                cancel.set()
+
+    async def _main(self, started: threading.Event) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._index = asyncio.Event()
+        started.set()
+        tasks: set[asyncio.Task] = set()
+        heartbeat = asyncio.create_task(self._heartbeat())
+        pool = asyncio.create_task(self._fill_pool())
+        dedup = asyncio.create_task(self._dedup_venvs())
+        index = asyncio.create_task(self._index_repositories())
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                await self._poll_cancels()
+            except Exception as e:
+                logger.error(f"The executor cancel poll encountered an error:\n{e}")
+            while len(self._runs) < self.workers:
+                try:
+                    db_jobs = await asyncio.to_thread(self._claim)
+                except Exception as e:
+                    logger.error(f"The executor claim encountered an error:\n{e}")
+                    break
+                if not db_jobs:
+                    break
+                task = asyncio.create_task(self._run(db_jobs))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), timeout=settings.executor_poll_interval
+                )
+            except TimeoutError:
+                pass
+        if tasks:
+            await asyncio.wait(tasks)
+        heartbeat.cancel()
+        pool.cancel()
+        dedup.cancel()
+        index.cancel()
+        self._loop = None
+        self._wakeup = None
+        self._index = None
+
+    async def _run(self, db_jobs: list[Job]) -> None:
+        db_job = db_jobs[0]
+        states = {job.id: JobStateEnum.failed for job in db_jobs}
+        cancel = asyncio.Event()
+        for job in db_jobs:
+            self._cancels[(job.id, job.attempts)] = cancel
+        timeout = self.timeouts.get(db_job.kind, settings.job_timeout)
+        try:
+            if db_job.options.get("batch") is None:
+                actives = {
+                    db_job.id: await run_job(job=db_job, cancel=cancel, timeout=timeout)
+                }
+            else:
+                actives = await run_batch(
+                    jobs=db_jobs,
+                    cancel=cancel,
+                    timeout=timeout * len(db_jobs) if timeout is not None else None,
+                )
+            for job_id, active in actives.items():
+                if active == ActiveEnum.inactive:
+                    states[job_id] = JobStateEnum.succeeded
+                elif active == ActiveEnum.cancelled:
+                    states[job_id] = JobStateEnum.cancelled
+                elif active == ActiveEnum.timeout:
+                    states[job_id] = JobStateEnum.timeout
+        except Exception as e:
+            logger.error(f"The executor job {db_job.id} encountered an error:\n{e}")
+            try:
+                await asyncio.to_thread(self._fail_journals, db_jobs, message=str(e))
+                if db_job.options.get("batch") is not None:
+                    await asyncio.to_thread(
+                        self._fail_batch, uuid.UUID(db_job.options["batch"])
+                    )
+            except Exception as e:
+                logger.error(f"The executor journal update encountered an error:\n{e}")
+        finally:
+            try:
+                saved = await asyncio.to_thread(self._finish, db_jobs, states=states)
+            except Exception as e:
+                saved = set()
+                logger.error(f"The executor job update encountered an error:\n{e}")
+            for job in db_jobs:
+                if job.kind == "venv":
+                    venvs.forget_installed_packages(
+                        job.options["extra_vars"]["venv_directory"]
+                    )
+                if job.id in saved:
+                    broker.publish(
+                        job.journal_id, {"event": "job", "state": states[job.id]}
+                    )
+                self._cancels.pop((job.id, job.attempts), None)
+            with self._lock:
+                for job in db_jobs:
+                    self._running.pop((job.id, job.attempts), None)
+                self._runs.pop((db_job.id, db_job.attempts), None)
+            if db_job.kind == "repository" and self._index is not None:
+                self._index.set()
+            self.wakeup()
+
+    def _finish(
+        self, db_jobs: list[Job], *, states: dict[uuid.UUID, JobStateEnum]
+    ) -> set[uuid.UUID]:
+        """Save the final state of the jobs of a run still claimed by it.
+
+        Returns the ids of the jobs whose state was saved.
+        """
+        saved = set()
+        with Session(engine) as session:
+            for job in db_jobs:
+                result = session.connection().execute(
+                    update(Job)
+                    .where(
+                        col(Job.id) == job.id,
+                        col(Job.claimed_by) == self.name,
+                        col(Job.attempts) == job.attempts,
+                        col(Job.state) == JobStateEnum.running,
+                    )
+                    .values(state=states[job.id], finished_at=datetime.utcnow())
+                )
+                if result.rowcount == 1:
+                    saved.add(job.id)
+                else:
+                    logger.warning(
+                        f"The executor job {job.id} lost its claim of attempt"
+                        f" {job.attempts}, its final state was not saved"
+                    )
+            session.commit()
+        return saved
+
+    def _fail_journals(self, db_jobs: list[Job], *, message: str) -> None:
+        with Session(engine) as session:
+            for job in db_jobs:
+                with utils.JournalWriter(
+                    session=session, journal_id=job.journal_id
+                ) as writer:
+                    writer.write(f"The executor job encountered an error: {message}")
+                utils.update_journal(
+                    session=session,
+                    journal_id=job.journal_id,
+                    journal=(
+                        JournalUpdate(active="failed", finished_at=datetime.utcnow())
+                    ),
+                )
+
+    def _fail_batch(self, batch: uuid.UUID) -> None:
+        with Session(engine) as session:
+            db_journal = session.get(Journal, batch)
+            if db_journal is None or db_journal.active in utils.finished:
+                return
+            utils.update_journal(
+                session=session,
+                journal_id=batch,
+                journal=(JournalUpdate(active="failed", finished_at=datetime.utcnow())),
+            )
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(settings.job_heartbeat_interval)
+            with self._lock:
+                running = list(self._running)
+            try:
+                lost = await asyncio.to_thread(self._renew, running)
+                for job_id, attempts in lost:
+                    cancel = self._cancels.get((job_id, attempts))
+                    if cancel is None:
+                        continue
+                    logger.warning(
+                        f"The executor job {job_id} lost its lease of attempt"
+                        f" {attempts}, stopping it"
+                    )
+                    cancel.set()
+                await asyncio.to_thread(self.recover)
+            except Exception as e:
+                logger.error(f"The executor heartbeat encountered an error:\n{e}")
+
+    def _renew(
+        self, running: list[tuple[uuid.UUID, int]]
+    ) -> list[tuple[uuid.UUID, int]]:
+        """Renew the leases of the claims in `running` and return those lost."""
+        now = datetime.utcnow()
+        lost = []
+        with Session(engine) as session:
+            for job_id, attempts in running:
+                result = session.connection().execute(
+                    update(Job)
+                    .where(
+                        col(Job.id) == job_id,
+                        col(Job.claimed_by) == self.name,
+                        col(Job.attempts) == attempts,
+                        col(Job.state) == JobStateEnum.running,
+                    )
+                    .values(
+                        heartbeat_at=now,
+                        lease_expires_at=now
+                        + timedelta(seconds=settings.job_lease_seconds),
+                    )
+                )
+                if result.rowcount != 1:
+                    lost.append((job_id, attempts))
+            session.commit()
+        return lost
+
+    async def _fill_pool(self) -> None:
+        if not settings.executor_native_venv or settings.venv_pool_size <= 0:
+            return
+        while True:
+            try:
+                if await asyncio.to_thread(venvs.fill_venv_pool):
+                    continue
+                await asyncio.sleep(settings.executor_poll_interval)
+            except Exception as e:
+                logger.error(f"The executor venv pool encountered an error:\n{e}")
+                await asyncio.sleep(settings.job_heartbeat_interval)
+
+    async def _dedup_venvs(self) -> None:
+        if settings.venv_dedup_interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(settings.venv_dedup_interval)
+            try:
+                queued = await asyncio.to_thread(self._queue_dedup)
+                if queued:
+                    logger.info(f"The executor queued {queued} venv dedup jobs")
+                    self.wakeup()
+            except Exception as e:
+                logger.error(f"The executor venv dedup encountered an error:\n{e}")
+
+    def _queue_dedup(self) -> int:
+        """Queue the dedup jobs of the venvs and the prune job of the venv store.
+
+        The jobs run in the queue of their unit, so a venv is never
+        deduplicated while another of its jobs runs. A unit whose last dedup
+        job is unfinished or was queued less than `venv_dedup_interval`
+        seconds ago is skipped, so the executors sharing the job table queue
+        each of them once per interval. Returns the number of jobs queued.
+        """
+        due = datetime.utcnow() - timedelta(seconds=settings.venv_dedup_interval)
+        with Session(engine) as session:
+            recent = select(Job.unit_id).where(
+                col(Job.kind) == "venv",
+                col(Job.tags).in_(["dedup", "prune"]),
+                or_(col(Job.finished_at).is_(None), col(Job.created_at) > due),
+            )
+            skip = set(session.exec(recent).all())
+            units = {
+                venv_id: (
+                    "dedup",
+                    str(Path(settings.venv_dir).resolve() / str(venv_id)),
+                )
+                for venv_id in session.exec(select(Venv.id)).all()
+            }
+            units[venvs.venv_store_unit] = (
+                "prune",
+                str(Path(settings.venv_store_dir).resolve()),
+            )
+            queued = 0
+            for unit_id, (tags, directory) in units.items():
+                if unit_id in skip:
+                    continue
+                self._queue(
+                    session=session,
+                    job=JobCreate(
+                        kind="venv",
+                        options={"extra_vars": {"venv_directory": directory}},
+                        playbook="app/playbooks/venv.yml",
+                        tags=tags,
+                        unit_id=unit_id,
+                    ),
+                )
+                queued += 1
+            session.commit()
+        return queued
+
+    async def _index_repositories(self) -> None:
+        if settings.repository_index_interval <= 0 or self._index is None:
+            return
+
+        def stale() -> list[tuple[uuid.UUID, str | None]]:
+            with Session(engine) as session:
+                busy = select(Job.unit_id).where(
+                    col(Job.kind) == "repository",
+                    col(Job.state).in_([JobStateEnum.queued, JobStateEnum.running]),
+                )
+                statement = select(Repository.id, Repository.commit).where(
+                    col(Repository.commit).is_distinct_from(
+                        col(Repository.indexed_commit)
+                    ),
+                    col(Repository.id).not_in(busy),
+                )
+                return [
+                    (repository_id, commit)
+                    for repository_id, commit in session.exec(statement).all()
+                ]
+
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._index.wait(), timeout=settings.repository_index_interval
+                )
+            except TimeoutError:
+                pass
+            self._index.clear()
+            try:
+                for repository_id, commit in await asyncio.to_thread(stale):
+                    playbooks = []
+                    if commit is not None:
+                        playbooks = await asyncio.to_thread(
+                            repositories.scan_repository,
+                            str(
+                                Path(settings.repository_dir).resolve()
+                                / str(repository_id)
+                            ),
+                        )
+                    await asyncio.to_thread(
+                        save_repository_playbooks,
+                        repository_id=repository_id,
+                        commit=commit,
+                        playbooks=playbooks,
+                    )
+            except Exception as e:
+                logger.error(
+                    f"The executor repository index encountered an error:\n{e}"
+                )
+
+
+executor = Executor(
+    workers=settings.executor_workers,
+    limits={
+        "venv": settings.executor_venv_workers or settings.executor_workers,
+        "repository": settings.executor_repository_workers or settings.executor_workers,
+    },
+    timeouts={
+        "venv": settings.job_venv_timeout or settings.job_timeout,
+        "repository": settings.job_repository_timeout or settings.job_timeout,
+    },
+)
@@ -3,8 +3,9 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
 from app import __version__
-from app.config import create_directories
+from app.config import create_directories, settings
 from app.database import create_db_and_tables
+from app.executor import executor
 from app.api.main import router as api_router
 
 
@@ -12,7 +13,12 @@ from app.api.main import router as api_router
 async def lifespan(app: FastAPI):
     create_directories()
     create_db_and_tables()
+    if settings.executor_embedded:
+        executor.recover()
+        executor.start()
     yield
+    if settings.executor_embedded:
+        executor.shutdown()
 
 
 app = FastAPI(
@@ -2,7 +2,16 @@ from datetime import datetime
 from enum import Enum
 import uuid
 
-from sqlmodel import Field, Relationship, SQLModel, UniqueConstraint, CheckConstraint
+from sqlmodel import (
+    JSON,
+    CheckConstraint,
+    Column,
+    Field,
+    Index,
+    Relationship,
+    SQLModel,
+    UniqueConstraint,
+)
 
 from app.config import settings
 
@@ -89,11 +98,13 @@ class TokenData(SQLModel):
 class ActiveEnum(str, Enum):
     activating = "activating"
     active = "active"
+    cancelled = "cancelled"
     deactivating = "deactivating"
     failed = "failed"
     inactive = "inactive"
     maintenance = "maintenance"
     reloading = "reloading"
+    timeout = "timeout"
 
 
 class JournalBase(SQLModel):
@@ -102,16 +113,31 @@ class JournalBase(SQLModel):
 
 
 class Journal(JournalBase, table=True):
+    __table_args__ = (
+        Index("ix_journal_active_id", "active", "id"),
+        Index("ix_journal_finished_at_id", "finished_at", "id"),
+        Index("ix_journal_started_at_id", "started_at", "id"),
+        Index("ix_journal_unit_id_id", "unit_id", "id"),
+    )
     if settings.database_type == "sqlite":
-        __table_args__ = (
+        __table_args__ += (
             CheckConstraint(
-                "active IN ('activating', 'active', 'deactivating', 'failed', 'inactive', 'maintenance', 'reloading')"
+                "active IN ('activating', 'active', 'cancelled', 'deactivating', 'failed', 'inactive', 'maintenance', 'reloading', 'timeout')"
             ),
         )
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    byte_count: int | None = None
+    exit_code: int | None = None
+    finished_at: datetime | None = None
+    line_count: int | None = None
+    max_rss: int | None = None
     messages: list["Journal_Message"] = Relationship(
         back_populates="journal", cascade_delete=True
     )
+    started_at: datetime | None = None
+    system_time: float | None = None
+    user_time: float | None = None
+    wall_time: float | None = None
 
 
 class JournalCreate(JournalBase):
@@ -120,10 +146,28 @@ class JournalCreate(JournalBase):
 
 class JournalUpdate(SQLModel):
     active: ActiveEnum
+    byte_count: int | None = None
+    exit_code: int | None = None
+    finished_at: datetime | None = None
+    line_count: int | None = None
+    max_rss: int | None = None
+    started_at: datetime | None = None
+    system_time: float | None = None
+    user_time: float | None = None
+    wall_time: float | None = None
 
 
 class JournalPublic(JournalBase):
     id: uuid.UUID
+    byte_count: int | None
+    exit_code: int | None
+    finished_at: datetime | None
+    line_count: int | None
+    max_rss: int | None
+    started_at: datetime | None
+    system_time: float | None
+    user_time: float | None
+    wall_time: float | None
 
 
 class JournalPublicWithMessages(JournalPublic):
@@ -136,6 +180,7 @@ class Journal_MessageBase(SQLModel):
 
 
 class Journal_Message(Journal_MessageBase, table=True):
+    __table_args__ = (Index("ix_journal_message_journal_id_id", "journal_id", "id"),)
     id: int | None = Field(default=None, primary_key=True)
     journal: Journal = Relationship(back_populates="messages")
     journal_id: uuid.UUID = Field(
@@ -148,18 +193,116 @@ class Journal_MessageCreate(Journal_MessageBase):
 
 
 class Journal_MessagePublic(Journal_MessageBase):
+    id: int
+
+
+class Journal_TaskBase(SQLModel):
+    action: str | None = Field(default=None, max_length=128)
+    changed: bool = False
+    duration: float
+    finished_at: datetime
+    host: str | None = Field(default=None, max_length=255)
+    item: str | None = None
+    started_at: datetime
+    status: str = Field(max_length=16)
+    task: str
+
+
+class Journal_Task(Journal_TaskBase, table=True):
+    __table_args__ = (Index("ix_journal_task_journal_id_id", "journal_id", "id"),)
+    id: int | None = Field(default=None, primary_key=True)
+    journal_id: uuid.UUID = Field(
+        foreign_key="journal.id", nullable=False, ondelete="CASCADE"
+    )
+
+
+class Journal_TaskPublic(Journal_TaskBase):
+    id: int
+
+
+# job
+class JobStateEnum(str, Enum):
+    cancelled = "cancelled"
+    failed = "failed"
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    timeout = "timeout"
+
+
+class JobBase(SQLModel):
+    kind: str = Field(max_length=32, min_length=1)
+    options: dict = Field(default_factory=dict, sa_column=Column(JSON))
+    playbook: str
+    tags: str
+    unit_id: uuid.UUID = Field(nullable=False)
+    venv_directory: str | None = None
+
+
+class Job(JobBase, table=True):
+    __table_args__ = (
+        Index("ix_job_state_created_at", "state", "created_at"),
+        Index("ix_job_unit_id_id", "unit_id", "id"),
+    )
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    journal_id: uuid.UUID = Field(
+        foreign_key="journal.id", nullable=False, ondelete="CASCADE"
+    )
+    attempts: int = 0
+    cancel_requested_at: datetime | None = None
+    claimed_at: datetime | None = None
+    claimed_by: str | None = Field(default=None, max_length=128)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    finished_at: datetime | None = None
+    heartbeat_at: datetime | None = None
+    lease_expires_at: datetime | None = None
+    state: JobStateEnum = Field(default=JobStateEnum.queued)
+
+
+class JobCreate(JobBase):
     pass
 
 
+class JobPublic(JobBase):
+    id: uuid.UUID
+    journal_id: uuid.UUID
+    attempts: int
+    cancel_requested_at: datetime | None
+    claimed_at: datetime | None
+    claimed_by: str | None
+    created_at: datetime
+    finished_at: datetime | None
+    heartbeat_at: datetime | None
+    lease_expires_at: datetime | None
+    state: JobStateEnum
+
+
 # repository
 class RepositoryBase(SQLModel):
+    depth: int | None = Field(default=None, ge=1)
+    filter: str | None = Field(
+        default=None,
+        max_length=64,
+        schema_extra=dict(pattern=r"^(blob:none|blob:limit=[0-9]+[kmg]?|tree:[0-9]+)$"),
+    )
     name: str = Field(index=True, max_length=128, min_length=1, unique=True)
-    ref: str | None = Field(default=None, max_length=64, min_length=1)
-    url: str = Field(index=True, max_length=128, min_length=1)
+    ref: str | None = Field(
+        default=None, max_length=64, min_length=1, schema_extra=dict(pattern=r"^[^-]")
+    )
+    sparse_paths: list[str] | None = Field(default=None, sa_column=Column(JSON))
+    url: str = Field(
+        index=True, max_length=128, min_length=1, schema_extra=dict(pattern=r"^[^-]")
+    )
 
 
 class Repository(RepositoryBase, table=True):
+    __table_args__ = (Index("ix_repository_venv_id_id", "venv_id", "id"),)
+    commit: str | None = Field(default=None, max_length=40)
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    indexed_commit: str | None = Field(default=None, max_length=40)
+    playbooks: list["Repository_Playbook"] = Relationship(
+        back_populates="repository", cascade_delete=True
+    )
     venv: "Venv" = Relationship(back_populates="repositories")
     venv_id: uuid.UUID = Field(
         foreign_key="venv.id", nullable=False, ondelete="RESTRICT"
@@ -170,14 +313,31 @@ class RepositoryCreate(RepositoryBase):
     venv_id: uuid.UUID
 
 
+class RepositoryInstall(SQLModel):
+    ids: list[uuid.UUID] | None = None
+    venv_id: uuid.UUID | None = None
+
+
 class RepositoryUpdate(SQLModel):
+    depth: int | None = Field(default=None, ge=1)
+    filter: str | None = Field(
+        default=None,
+        max_length=64,
+        schema_extra=dict(pattern=r"^(blob:none|blob:limit=[0-9]+[kmg]?|tree:[0-9]+)$"),
+    )
     name: str | None = Field(default=None, max_length=128, min_length=1, unique=True)
-    ref: str | None = Field(default=None, max_length=64, min_length=1)
-    url: str | None = Field(default=None, max_length=128, min_length=1)
+    ref: str | None = Field(
+        default=None, max_length=64, min_length=1, schema_extra=dict(pattern=r"^[^-]")
+    )
+    sparse_paths: list[str] | None = Field(default=None)
+    url: str | None = Field(
+        default=None, max_length=128, min_length=1, schema_extra=dict(pattern=r"^[^-]")
+    )
     venv_id: uuid.UUID | None = Field(default=None)
 
 
 class RepositoryPublic(RepositoryBase):
+    commit: str | None = None
     id: uuid.UUID
 
 
@@ -189,6 +349,36 @@ class RepositoryPublicWithJournal(RepositoryPublic):
     journal_id: uuid.UUID
 
 
+# repository playbook
+class Repository_PlaybookKindEnum(str, Enum):
+    playbook = "playbook"
+    requirements = "requirements"
+    role = "role"
+
+
+class Repository_PlaybookBase(SQLModel):
+    description: str | None = Field(default=None, max_length=256)
+    kind: Repository_PlaybookKindEnum
+    name: str = Field(index=True, max_length=255)
+    path: str
+
+
+class Repository_Playbook(Repository_PlaybookBase, table=True):
+    __table_args__ = (
+        Index("ix_repository_playbook_repository_id_id", "repository_id", "id"),
+    )
+    id: int | None = Field(default=None, primary_key=True)
+    repository: Repository = Relationship(back_populates="playbooks")
+    repository_id: uuid.UUID = Field(
+        foreign_key="repository.id", nullable=False, ondelete="CASCADE"
+    )
+
+
+class Repository_PlaybookPublic(Repository_PlaybookBase):
+    id: int
+    repository_id: uuid.UUID
+
+
 # credential
 class CredentialBase(SQLModel):
     name: str = Field(index=True, max_length=128, min_length=1, unique=True)
@@ -280,7 +470,10 @@ class Venv_PackageBase(SQLModel):
 
 
 class Venv_Package(Venv_PackageBase, table=True):
-    __table_args__ = (UniqueConstraint("name", "venv_id"),)
+    __table_args__ = (
+        UniqueConstraint("name", "venv_id"),
+        Index("ix_venv_package_venv_id_id", "venv_id", "id"),
+    )
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     venv: Venv = Relationship(back_populates="packages")
     venv_id: uuid.UUID = Field(
@@ -303,9 +496,35 @@ class Venv_PackageUpdate(SQLModel):
     )
 
 
+class Venv_InstalledPackagePublic(SQLModel):
+    name: str
+    requested: bool
+    version: str
+
+
 class Venv_PackagePublic(Venv_PackageBase):
     id: uuid.UUID
 
 
 class Venv_PackagePublicWithVenv(Venv_PackagePublic):
     venv: Venv
+
+
+# virtual environment lock
+class Venv_LockBase(SQLModel):
+    key: str = Field(max_length=64, min_length=64)
+    packages: list = Field(default_factory=list, sa_column=Column(JSON))
+
+
+class Venv_Lock(Venv_LockBase, table=True):
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    venv_id: uuid.UUID = Field(
+        foreign_key="venv.id", nullable=False, ondelete="CASCADE", unique=True
+    )
+
+
+class Venv_LockPublic(Venv_LockBase):
+    id: uuid.UUID
+    created_at: datetime
+    venv_id: uuid.UUID
@@ -0,0 +1,195 @@
+import base64
+import binascii
+import json
+import uuid
+from datetime import datetime
+from enum import Enum
+from typing import Annotated, Any
+
+from fastapi import Depends, HTTPException, Query, Response
+from sqlmodel import (
+    Field,
+    Session,
+    SQLModel,
+    and_,
+    func,
+    literal,
+    literal_column,
+    or_,
+    select,
+    tuple_,
+)
+
+from app.config import settings
+
+
+class OrderEnum(str, Enum):
+    asc = "asc"
+    desc = "desc"
+
+
+class Pagination(SQLModel):
+    after: str | None = None
+    limit: int = Field(default=settings.pagination_limit, ge=1, le=1000)
+    order: OrderEnum = OrderEnum.asc
+    sort: str = "id"
+
+
+def get_pagination(
+    after: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = settings.pagination_limit,
+    order: OrderEnum = OrderEnum.asc,
+    sort: str = "id",
+) -> Pagination:
+    return Pagination(after=after, limit=limit, order=order, sort=sort)
+
+
+PaginationDep = Annotated[Pagination, Depends(get_pagination)]
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor: str, columns: list) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError
+        decoded: list = []
+        for value, column in zip(values, columns):
+            try:
+                python_type = column.type.python_type
+            except NotImplementedError:
+                python_type = str
+            if value is None:
+                decoded.append(None)
+            elif issubclass(python_type, datetime):
+                decoded.append(datetime.fromisoformat(value))
+            elif issubclass(python_type, uuid.UUID):
+                decoded.append(uuid.UUID(value))
+            else:
+                decoded.append(python_type(value))
+        return decoded
+    except (binascii.Error, TypeError, ValueError):
+        raise HTTPException(
+            status_code=400,
+            detail="The cursor(after) is not valid",
+        )
+
+
+def estimate_count(*, session: Session, statement: Any, model: Any) -> tuple[int, bool]:
+    """Count the rows of `statement`, reading at most `pagination_count_limit`.
+
+    Past the limit the count is estimated from the largest rowid of the table
+    when the statement is not filtered, and is the limit otherwise. The second
+    value tells whether the count is exact.
+    """
+    limit = settings.pagination_count_limit
+    count = session.exec(
+        select(func.count()).select_from(statement.limit(limit + 1).subquery())
+    ).one()
+    if count <= limit:
+        return count, True
+    if statement.whereclause is None and settings.database_type == "sqlite":
+        rowid: int | None = session.exec(
+            select(func.max(literal_column("rowid"))).select_from(model)
+        ).one()
+        return max(rowid or 0, limit), False
+    return limit, False
+
+
+def after_nullable(
+    *, column: Any, id_column: Any, value: Any, id_value: Any, order: OrderEnum
+) -> Any:
+    """Return the clause selecting the rows after a cursor on a nullable column.
+
+    Null values come first in ascending order and last in descending order,
+    like in SQLite, and rows with the same value are ordered by id.
+    """
+    if order == OrderEnum.asc:
+        if value is None:
+            return or_(
+                and_(column.is_(None), id_column > id_value), column.is_not(None)
+            )
+        return or_(column > value, and_(column == value, id_column > id_value))
+    if value is None:
+        return and_(column.is_(None), id_column < id_value)
+    return or_(
+        column < value, and_(column == value, id_column < id_value), column.is_(None)
+    )
+
+
+def paginate(
+    *,
+    session: Session,
+    response: Response,
+    model: Any,
+    pagination: Pagination,
+    sorts: list[str],
+    filters: dict[str, Any] | None = None,
+    where: list | None = None,
+) -> list:
+    """Return one page of `model` rows using keyset pagination.
+
+    Rows are filtered by the `filters` that are not None and by the `where`
+    clauses, ordered by `pagination.sort`, one of `sorts`, and then by id, with
+    null values first in ascending order, and the page starts after the row
+    encoded in `pagination.after`. The cursor of the next page and the total
+    count are returned in the X-Next-Cursor and X-Total-Count headers, and
+    X-Total-Count-Exact tells whether that count is an estimate.
+    """
+    if pagination.sort not in sorts:
+        raise HTTPException(
+            status_code=400,
+            detail="The sort must be one of: " + ", ".join(sorts),
+        )
+    columns = [getattr(model, pagination.sort)]
+    if pagination.sort != "id":
+        columns.append(model.id)
+    statement = select(model)
+    for key, value in (filters or {}).items():
+        if value is not None:
+            statement = statement.where(getattr(model, key) == value)
+    for clause in where or []:
+        statement = statement.where(clause)
+    count, exact = estimate_count(session=session, statement=statement, model=model)
+    nullable = len(columns) > 1 and columns[0].nullable
+    if pagination.after is not None:
+        decoded = decode_cursor(pagination.after, columns)
+        values = [
+            literal(value, column.type) for value, column in zip(decoded, columns)
+        ]
+        if nullable:
+            statement = statement.where(
+                after_nullable(
+                    column=columns[0],
+                    id_column=columns[1],
+                    value=None if decoded[0] is None else values[0],
+                    id_value=values[1],
+                    order=pagination.order,
+                )
+            )
+        elif pagination.order == OrderEnum.asc:
+            statement = statement.where(tuple_(*columns) > tuple_(*values))
+        else:
+            statement = statement.where(tuple_(*columns) < tuple_(*values))
+    if pagination.order == OrderEnum.asc:
+        orders = [column.asc() for column in columns]
+        if nullable:
+            orders[0] = orders[0].nulls_first()
+    else:
+        orders = [column.desc() for column in columns]
+        if nullable:
+            orders[0] = orders[0].nulls_last()
+    statement = statement.order_by(*orders)
+    items = list(session.exec(statement.limit(pagination.limit + 1)).all())
+    if len(items) > pagination.limit:
+        items = items[: pagination.limit]
+        last = items[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(
+            [getattr(last, column.key) for column in columns]
+        )
+    response.headers["X-Total-Count"] = str(count)
+    response.headers["X-Total-Count-Exact"] = str(exact).lower()
+    return items
@@ -0,0 +1,238 @@
+import hashlib
+import os
+import re
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore[assignment]
+
+from app.config import settings
+from app.models import JobCreate, Repository
+
+
+playbook_keys = frozenset(
+    {"ansible.builtin.import_playbook", "hosts", "import_playbook"}
+)
+
+
+class YamlLoader(SafeLoader):
+    pass
+
+
+YamlLoader.add_multi_constructor("!", lambda loader, suffix, node: None)
+
+
+def mirror_directory(url: str) -> str:
+    return str(
+        Path(settings.repository_mirror_dir).resolve()
+        / f"{hashlib.sha256(url.encode()).hexdigest()}.git"
+    )
+
+
+def run_git(*args: str) -> str | None:
+    try:
+        process = subprocess.run(
+            ["git", *args],
+            capture_output=True,
+            stdin=subprocess.DEVNULL,
+            text=True,
+            timeout=settings.repository_resolve_timeout,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if process.returncode != 0:
+        return None
+    return process.stdout
+
+
+_remote_cache: dict[str, tuple[float, dict[str, str]]] = {}
+_remote_lock = threading.Lock()
+
+
+def list_remote_refs(url: str) -> dict[str, str] | None:
+    """Return the commits of the refs of the remote at `url`, by ref name.
+
+    The refs come from `git ls-remote`, which transfers no objects, and are
+    cached for `repository_resolve_interval` seconds, so the repositories
+    sharing an url list it once.
+    """
+    with _remote_lock:
+        cached = _remote_cache.get(url)
+    if cached is not None and time.monotonic() - cached[0] < (
+        settings.repository_resolve_interval
+    ):
+        return cached[1]
+    output = run_git("ls-remote", "--", url)
+    if output is None:
+        return None
+    refs = {}
+    for line in output.splitlines():
+        commit, _, name = line.partition("\t")
+        refs[name] = commit
+    with _remote_lock:
+        _remote_cache[url] = (time.monotonic(), refs)
+    return refs
+
+
+def resolve_remote_ref(url: str, ref: str | None = None) -> str | None:
+    """Return the commit `ref` points at in the remote at `url`.
+
+    `ref` defaults to the HEAD of the remote, and may be a full commit, a ref
+    name, a tag or a branch. It is None when the ref cannot be resolved from
+    the refs of the remote, like an abbreviated commit.
+    """
+    if ref is not None and re.fullmatch(r"[0-9a-f]{40}", ref):
+        return ref
+    refs = list_remote_refs(url)
+    if refs is None:
+        return None
+    ref = ref or "HEAD"
+    for name in (ref, f"refs/tags/{ref}^{{}}", f"refs/tags/{ref}", f"refs/heads/{ref}"):
+        if name in refs:
+            return refs[name]
+    return None
+
+
+def head_commit(repository_directory: str) -> str | None:
+    if not (Path(repository_directory) / ".git").exists():
+        return None
+    output = run_git("-C", repository_directory, "rev-parse", "--verify", "HEAD")
+    if output is None:
+        return None
+    return output.strip()
+
+
+def install_job(db_repository: Repository) -> JobCreate:
+    """Return the job installing `db_repository` with app/playbooks/repository.yml.
+
+    The playbook installs each of the `repositories` of its extra vars, so
+    the install jobs of a batch run together by joining their repositories.
+    """
+    directory = str(Path(settings.repository_dir).resolve() / str(db_repository.id))
+    repository: dict = {"directory": directory, "url": db_repository.url}
+    if db_repository.depth is not None:
+        repository["depth"] = db_repository.depth
+    if db_repository.filter is not None:
+        repository["filter"] = db_repository.filter
+    if (
+        settings.repository_mirror
+        and db_repository.depth is None
+        and db_repository.filter is None
+    ):
+        repository["mirror"] = mirror_directory(db_repository.url)
+    if db_repository.ref is not None:
+        repository["ref"] = db_repository.ref
+    if db_repository.sparse_paths:
+        repository["sparse_paths"] = list(db_repository.sparse_paths)
+    return JobCreate(
+        kind="repository",
+        options={
+            "extra_vars": {
+                "repositories": [repository],
+                "repository_directory": directory,
+            },
+            "inventory": "localhost,",
+        },
+        playbook="app/playbooks/repository.yml",
+        tags="install",
+        unit_id=db_repository.id,
+        venv_directory=str(Path(settings.venv_dir) / str(db_repository.venv_id)),
+    )
+
+
+def load_yaml(path: str, *, max_size: int = 1024 * 1024) -> object:
+    """Load the YAML file at `path`, ignoring tags like !vault.
+
+    Returns None when the file is larger than `max_size` or is not valid.
+    """
+    try:
+        if os.path.getsize(path) > max_size:
+            return None
+        with open(path, "rb") as file:
+            return yaml.load(file, Loader=YamlLoader)
+    except (OSError, ValueError, yaml.YAMLError):
+        return None
+
+
+def scan_repository(repository_directory: str) -> list[dict]:
+    """Return the playbooks, roles and requirements files of a checkout.
+
+    Roles are the directories of a roles directory that have a tasks or a
+    meta directory, and are not scanned further. Playbooks are the YAML files
+    holding a list of plays, and requirements the requirements.yml files.
+    Hidden directories, like .git, are skipped.
+    """
+    entries = []
+    for root, directories, files in os.walk(repository_directory):
+        directories[:] = sorted(
+            directory for directory in directories if not directory.startswith(".")
+        )
+        relative = os.path.relpath(root, repository_directory)
+        if os.path.basename(root) == "roles":
+            for name in list(directories):
+                role = os.path.join(root, name)
+                if not (
+                    os.path.isdir(os.path.join(role, "tasks"))
+                    or os.path.isdir(os.path.join(role, "meta"))
+                ):
+                    continue
+                directories.remove(name)
+                meta = load_yaml(os.path.join(role, "meta", "main.yml"))
+                if meta is None:
+                    meta = load_yaml(os.path.join(role, "meta", "main.yaml"))
+                galaxy_info = (
+                    meta.get("galaxy_info") if isinstance(meta, dict) else None
+                )
+                description = (
+                    galaxy_info.get("description")
+                    if isinstance(galaxy_info, dict)
+                    else None
+                )
+                entries.append(
+                    {
+                        "description": str(description)[:256] if description else None,
+                        "kind": "role",
+                        "name": name,
+                        "path": os.path.normpath(os.path.join(relative, name)),
+                    }
+                )
+        for name in sorted(files):
+            stem, extension = os.path.splitext(name)
+            if extension not in (".yml", ".yaml"):
+                continue
+            path = os.path.normpath(os.path.join(relative, name))
+            if stem == "requirements":
+                entries.append(
+                    {
+                        "description": None,
+                        "kind": "requirements",
+                        "name": stem,
+                        "path": path,
+                    }
+                )
+                continue
+            plays = load_yaml(os.path.join(root, name))
+            if (
+                not isinstance(plays, list)
+                or not plays
+                or not all(isinstance(play, dict) for play in plays)
+                or not any(playbook_keys & play.keys() for play in plays)
+            ):
+                continue
+            description = plays[0].get("name")
+            entries.append(
+                {
+                    "description": str(description)[:256] if description else None,
+                    "kind": "playbook",
+                    "name": stem,
+                    "path": path,
+                }
+            )
+    return entries
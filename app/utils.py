@@ -1,19 +1,66 @@
+import asyncio
+import codecs
+import contextlib
+import fcntl
+import functools
 import json
 import logging
+import os
+import resource
+import shutil
+import signal
 import subprocess
+import time
 import uuid
+from collections import Counter
+from collections.abc import AsyncIterator, Callable
+from datetime import datetime
+from pathlib import Path
+from typing import IO
 
-from sqlmodel import Session
+from sqlmodel import Session, col, insert, select
+
+from app.broker import broker
+from app.config import settings
+from app.database import engine
 from app.models import (
+    ActiveEnum,
+    Job,
+    JobStateEnum,
     Journal,
     JournalCreate,
     JournalUpdate,
     Journal_Message,
-    Journal_MessageCreate,
+    Journal_Task,
 )
+from app import venvs
 
 logger = logging.getLogger("uvicorn")
 
+callback_plugins = str(Path(__file__).parent.resolve() / "callback_plugins")
+
+finished = (
+    ActiveEnum.cancelled,
+    ActiveEnum.failed,
+    ActiveEnum.inactive,
+    ActiveEnum.timeout,
+)
+
+repository_tasks = {
+    "install": "Installing repository",
+    "reconcile": "Installing repository",
+}
+
+venv_tasks = {
+    "clone": "Installing venv from template",
+    "create": "Creating venv",
+    "dedup": "Deduplicating venv",
+    "delete": "Deleting venv",
+    "prune": "Pruning venv store",
+    "reconcile": "Installing venv",
+    "uninstall": "Uninstalling venv",
+}
+
 
 def create_journal(*, session: Session, journal: JournalCreate) -> uuid.UUID:
     db_journal = Journal.model_validate(journal)
@@ -32,31 +79,501 @@ def update_journal(
         setattr(db_journal, key, value)
     session.add(db_journal)
     session.commit()
+    broker.publish(
+        journal_id,
+        {"event": "state", **journal.model_dump(mode="json", exclude_unset=True)},
+    )
 
 
-def create_journal_message(
-    *, session: Session, journal_message: Journal_MessageCreate
+async def update_journal_async(
+    *, journal_id: uuid.UUID, journal: JournalUpdate
 ) -> None:
-    db_journal = session.get(Journal, journal_message.journal_id)
-    if not db_journal:
-        raise Exception(
-            f"The journal with this id does not exist in the system: {journal_message.journal_id}"
+    """Run `update_journal` in a worker thread with a session of its own."""
+
+    def update() -> None:
+        with Session(engine) as session:
+            update_journal(session=session, journal_id=journal_id, journal=journal)
+
+    await asyncio.to_thread(update)
+
+
+class JournalWriter:
+    """Buffer journal messages and task events and insert them in batches.
+
+    Both are flushed in a single transaction once `flush_lines` rows are
+    buffered or `flush_interval` seconds have passed since the last flush.
+    Used as a context manager, the remaining rows are always flushed on exit,
+    including when an exception is raised. `results` holds the status of the
+    last event of each task.
+
+    The async methods flush in a worker thread with a session of their own,
+    one flush at a time, so the event loop is not blocked by the database.
+    Used as an async context manager, the remaining rows are flushed that way
+    on exit. Without `session`, the journal is not looked up first and the
+    sync methods flush with a session of their own too.
+    """
+
+    def __init__(
+        self,
+        *,
+        session: Session | None = None,
+        journal_id: uuid.UUID,
+        flush_lines: int | None = None,
+        flush_interval: float | None = None,
+    ) -> None:
+        if session is not None and not session.get(Journal, journal_id):
+            raise Exception(
+                f"The journal with this id does not exist in the system: {journal_id}"
+            )
+        self.session = session
+        self.journal_id = journal_id
+        self.flush_lines = (
+            flush_lines if flush_lines is not None else settings.journal_flush_lines
         )
-    db_journal_message = Journal_Message.model_validate(journal_message)
-    session.add(db_journal_message)
-    session.commit()
+        self.flush_interval = (
+            flush_interval
+            if flush_interval is not None
+            else settings.journal_flush_interval
+        )
+        self.results: dict[str, str] = {}
+        self._buffer: list[dict] = []
+        self._tasks: list[dict] = []
+        self._flushed_at = time.monotonic()
+        self._flushing = asyncio.Lock()
+
+    def __enter__(self) -> "JournalWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+    async def __aenter__(self) -> "JournalWriter":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.flush_async()
+
+    def write(self, message: str) -> None:
+        self._append(message)
+        if self._flush_due():
+            self.flush()
+
+    def write_task(self, event: dict) -> None:
+        self._append_task(event)
+        if self._flush_due():
+            self.flush()
+
+    async def write_async(self, message: str) -> None:
+        self._append(message)
+        if self._flush_due():
+            await self.flush_async()
+
+    async def write_task_async(self, event: dict) -> None:
+        self._append_task(event)
+        if self._flush_due():
+            await self.flush_async()
+
+    def _append(self, message: str) -> None:
+        self._buffer.append(
+            {
+                "journal_id": self.journal_id,
+                "message": message,
+                "timestamp": datetime.utcnow(),
+            }
+        )
+
+    def _append_task(self, event: dict) -> None:
+        self.results[event["task"]] = event["status"]
+        self._tasks.append(
+            {
+                "journal_id": self.journal_id,
+                "action": event.get("action"),
+                "changed": bool(event.get("changed")),
+                "duration": event["duration"],
+                "finished_at": datetime.utcfromtimestamp(event["finished_at"]),
+                "host": event.get("host"),
+                "item": event.get("item"),
+                "started_at": datetime.utcfromtimestamp(event["started_at"]),
+                "status": event["status"],
+                "task": event["task"],
+            }
+        )
+
+    def _flush_due(self) -> bool:
+        return (
+            len(self._buffer) + len(self._tasks) >= self.flush_lines
+            or time.monotonic() - self._flushed_at >= self.flush_interval
+        )
+
+    def _take(self) -> tuple[list[dict], list[dict]]:
+        self._flushed_at = time.monotonic()
+        rows, self._buffer = self._buffer, []
+        tasks, self._tasks = self._tasks, []
+        return rows, tasks
+
+    def flush(self) -> None:
+        rows, tasks = self._take()
+        if self.session is not None:
+            self._insert(session=self.session, rows=rows, tasks=tasks)
+        elif rows or tasks:
+            with Session(engine) as session:
+                self._insert(session=session, rows=rows, tasks=tasks)
+
+    async def flush_async(self) -> None:
+        async with self._flushing:
+            rows, tasks = self._take()
+            if not rows and not tasks:
+                return
+
+            def insert_rows() -> None:
+                with Session(engine) as session:
+                    self._insert(session=session, rows=rows, tasks=tasks)
+
+            await asyncio.to_thread(insert_rows)
+
+    def _insert(self, *, session: Session, rows: list[dict], tasks: list[dict]) -> None:
+        if not rows and not tasks:
+            return
+        ids: list = []
+        if rows:
+            statement = insert(Journal_Message).returning(
+                col(Journal_Message.id), sort_by_parameter_order=True
+            )
+            ids = list(session.scalars(statement, rows).all())
+        if tasks:
+            session.execute(insert(Journal_Task), tasks)
+        session.commit()
+        if rows and broker.subscribed(self.journal_id):
+            broker.publish(
+                self.journal_id,
+                {
+                    "event": "messages",
+                    "messages": [
+                        {
+                            "id": id,
+                            "message": row["message"],
+                            "timestamp": row["timestamp"].isoformat(),
+                        }
+                        for id, row in zip(ids, rows)
+                    ],
+                },
+            )
+
+
+def format_event(*, event: str, data: dict, id: int | None = None) -> str:
+    lines = [f"event: {event}", f"data: {json.dumps(data)}"]
+    if id is not None:
+        lines.insert(0, f"id: {id}")
+    return "\n".join(lines) + "\n\n"
+
+
+def read_journal(
+    *, journal_id: uuid.UUID, after_id: int
+) -> tuple[ActiveEnum, list[Journal_Message], bool] | None:
+    """Return the state of a journal, its messages after `after_id` and if a
+    job is queued or running for it, or None when the journal does not exist.
+    """
+    with Session(engine) as session:
+        db_journal = session.get(Journal, journal_id)
+        if not db_journal:
+            return None
+        statement = (
+            select(Journal_Message)
+            .where(
+                Journal_Message.journal_id == journal_id,
+                col(Journal_Message.id) > after_id,
+            )
+            .order_by(col(Journal_Message.id))
+        )
+        db_journal_messages = list(session.exec(statement).all())
+        statement = select(Job.id).where(
+            Job.journal_id == journal_id,
+            col(Job.state).in_([JobStateEnum.queued, JobStateEnum.running]),
+        )
+        pending = session.exec(statement).first() is not None
+        return db_journal.active, db_journal_messages, pending
+
+
+async def stream_journal(
+    *, journal_id: uuid.UUID, after_id: int | None = None
+) -> AsyncIterator[str]:
+    """Yield the messages and state changes of a journal as server-sent events.
+
+    The messages already stored are sent first, then the events published by
+    the journal writer are pushed as they arrive. The journal is read again
+    from the database whenever its state changes, the subscription lagged or
+    nothing was published for `journal_stream_interval` seconds, which also
+    picks up the jobs run by other processes. The stream ends once the journal
+    is inactive, failed, cancelled or timed out and no job is queued or
+    running for it. The database is read in a worker thread.
+    """
+    subscription = broker.subscribe(journal_id)
+    try:
+        last_id = after_id or 0
+        active = None
+        while True:
+            read = await asyncio.to_thread(
+                read_journal, journal_id=journal_id, after_id=last_id
+            )
+            if read is None:
+                return
+            db_active, db_journal_messages, pending = read
+            for db_journal_message in db_journal_messages:
+                if db_journal_message.id is not None:
+                    last_id = db_journal_message.id
+                yield format_event(
+                    event="message",
+                    data=db_journal_message.model_dump(mode="json"),
+                    id=last_id,
+                )
+            if db_active != active:
+                active = db_active
+                yield format_event(event="state", data={"active": active})
+            if active in finished and not pending:
+                yield format_event(event="end", data={"active": active})
+                return
+            subscription.lagged = False
+            yield ": keepalive\n\n"
+            while not subscription.lagged:
+                try:
+                    event = await asyncio.wait_for(
+                        subscription.queue.get(),
+                        timeout=settings.journal_stream_interval,
+                    )
+                except TimeoutError:
+                    break
+                if event["event"] != "messages":
+                    break
+                for message in event["messages"]:
+                    if message["id"] > last_id:
+                        last_id = message["id"]
+                        yield format_event(event="message", data=message, id=last_id)
+    finally:
+        broker.unsubscribe(journal_id, subscription)
+
+
+async def read_lines(
+    stream: asyncio.StreamReader,
+    *,
+    interval: float,
+    size: int = 65536,
+    counts: Counter | None = None,
+) -> AsyncIterator[str | None]:
+    """Yield the lines read from `stream` in chunks of up to `size` bytes.
+
+    The chunks are decoded incrementally, so a character split across two
+    chunks is decoded once it is complete. None is yielded whenever no data
+    arrived for `interval` seconds, letting the caller flush what it buffered.
+    The number of lines and bytes read are added to `counts`.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    while True:
+        try:
+            chunk = await asyncio.wait_for(stream.read(size), timeout=interval)
+        except TimeoutError:
+            yield None
+            continue
+        if not chunk:
+            break
+        if counts is not None:
+            counts["bytes"] += len(chunk)
+        *lines, pending = (pending + decoder.decode(chunk)).split("\n")
+        for line in lines:
+            if counts is not None:
+                counts["lines"] += 1
+            yield line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        if counts is not None:
+            counts["lines"] += 1
+        yield pending
+
+
+async def wait_process(
+    process: subprocess.Popen,
+) -> tuple[int, resource.struct_rusage]:
+    """Reap `process` with os.wait4 and return its exit code and resource usage.
+
+    The usage covers the process and the descendants it waited for. The exit is
+    awaited through a pidfd when the platform has one, and on a worker thread
+    otherwise.
+    """
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        _, status, rusage = await asyncio.to_thread(os.wait4, process.pid, 0)
+    else:
+        try:
+            loop = asyncio.get_running_loop()
+            exited = loop.create_future()
+
+            def set_exited() -> None:
+                if not exited.done():
+                    exited.set_result(None)
+
+            loop.add_reader(pidfd, set_exited)
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+            _, status, rusage = os.wait4(process.pid, 0)
+        finally:
+            os.close(pidfd)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, rusage
+
+
+async def open_pipe(
+    file: IO[bytes],
+) -> tuple[asyncio.StreamReader, asyncio.BaseTransport]:
+    loop = asyncio.get_running_loop()
+    stream = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(stream), file
+    )
+    return stream, transport
+
+
+async def read_output(
+    *, file: IO[bytes], writer: JournalWriter, counts: Counter
+) -> None:
+    stream, transport = await open_pipe(file)
+    try:
+        async for line in read_lines(
+            stream, interval=writer.flush_interval, counts=counts
+        ):
+            if line is None:
+                await writer.flush_async()
+            else:
+                await writer.write_async(line.rstrip())
+    finally:
+        transport.close()
+
+
+def format_task_result(event: dict) -> str:
+    host = event.get("host")
+    if event["status"] == "failed":
+        result = f"fatal: [{host}]: FAILED!"
+    elif event["status"] == "unreachable":
+        result = f"fatal: [{host}]: UNREACHABLE!"
+    elif event["status"] == "skipped":
+        result = f"skipping: [{host}]"
+    elif event["status"] == "ignored":
+        result = f"fatal: [{host}]: FAILED! ...ignoring"
+    else:
+        result = f"{'changed' if event.get('changed') else 'ok'}: [{host}]"
+    if event.get("msg") is not None:
+        result += f" => {json.dumps({'msg': event['msg']}, default=str)}"
+    return result
+
+
+async def read_events(
+    *,
+    file: IO[bytes],
+    writer: JournalWriter,
+    items: dict[str, JournalWriter] | None = None,
+) -> None:
+    """Write the task events read from `file` to `writer`.
+
+    The events of a loop item labelled with a key of `items` are also
+    written, with a summary of their result, to the writer of that item.
+    """
+    stream, transport = await open_pipe(file)
+    try:
+        async for line in read_lines(stream, interval=writer.flush_interval):
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+                await writer.write_task_async(event)
+                item = (items or {}).get(event.get("item"))
+                if item is not None:
+                    await item.write_async(f"TASK [{event['task']}]")
+                    await item.write_async(format_task_result(event))
+                    await item.write_task_async(event)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(
+                    f"The switcher_events callback sent an invalid event:\n{e}"
+                )
+    finally:
+        transport.close()
+
+
+def signal_process_group(process: subprocess.Popen, sig: int) -> None:
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def read_process(
+    *,
+    process: subprocess.Popen,
+    events_file: IO[bytes] | None,
+    writer: JournalWriter,
+    counts: Counter,
+    items: dict[str, JournalWriter] | None = None,
+) -> None:
+    async with asyncio.TaskGroup() as task_group:
+        if process.stdout is not None:
+            task_group.create_task(
+                read_output(file=process.stdout, writer=writer, counts=counts)
+            )
+        if events_file is not None:
+            task_group.create_task(
+                read_events(file=events_file, writer=writer, items=items)
+            )
+
+
+async def supervise_process(
+    *,
+    process: subprocess.Popen,
+    reading: asyncio.Task,
+    cancel: asyncio.Event | None,
+    timeout: float | None,
+) -> ActiveEnum | None:
+    """Wait for `reading` to finish, stopping the process early when needed.
+
+    The process group of `process` is sent SIGTERM when `cancel` is set or
+    after `timeout` seconds, and SIGKILL once `job_kill_timeout` seconds
+    passed or the output pipes were closed, after which the pipes are given
+    `job_kill_timeout` seconds more to close. Returns ActiveEnum.cancelled or
+    ActiveEnum.timeout when the process was stopped, and None otherwise.
+    """
+    waiters: set[asyncio.Future] = {reading}
+    cancelled = None
+    if cancel is not None:
+        cancelled = asyncio.create_task(cancel.wait())
+        waiters.add(cancelled)
+    try:
+        done, _ = await asyncio.wait(
+            waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        if cancelled is not None:
+            cancelled.cancel()
+    if reading in done:
+        return None
+    active = ActiveEnum.cancelled if cancelled in done else ActiveEnum.timeout
+    signal_process_group(process, signal.SIGTERM)
+    await asyncio.wait({reading}, timeout=settings.job_kill_timeout)
+    signal_process_group(process, signal.SIGKILL)
+    await asyncio.wait({reading}, timeout=settings.job_kill_timeout)
+    return active
 
 
-def run_ansible_playbook(
+async def run_ansible_playbook(
     *,
-    session=Session,
     venv_directory: str | None = None,
     playbook: str,
     options: dict,
     journal_id: uuid.UUID,
-) -> None:
-    update_journal(
-        session=session,
+    cancel: asyncio.Event | None = None,
+    timeout: float | None = None,
+    items: dict[str, JournalWriter] | None = None,
+) -> ActiveEnum:
+    await update_journal_async(
         journal_id=journal_id,
         journal=(JournalUpdate(active="activating")),
     )
@@ -72,54 +589,303 @@ def run_ansible_playbook(
         if key == "tags":
             command.extend(["--tags", value])
     command.append(playbook)
-    update_journal(
-        session=session,
+    started_at = datetime.utcnow()
+    await update_journal_async(
         journal_id=journal_id,
-        journal=(JournalUpdate(active="active")),
+        journal=(JournalUpdate(active="active", started_at=started_at)),
     )
+    env = dict(os.environ)
+    events = None
+    if settings.journal_tasks:
+        events = os.pipe()
+        env.update(
+            {
+                "ANSIBLE_CALLBACK_PLUGINS": os.pathsep.join(
+                    filter(
+                        None, [callback_plugins, env.get("ANSIBLE_CALLBACK_PLUGINS")]
+                    )
+                ),
+                "ANSIBLE_CALLBACKS_ENABLED": ",".join(
+                    filter(
+                        None, ["switcher_events", env.get("ANSIBLE_CALLBACKS_ENABLED")]
+                    )
+                ),
+                "SWITCHER_EVENTS_FD": str(events[1]),
+            }
+        )
+    started = time.monotonic()
     try:
         process = subprocess.Popen(
             command,
+            env=env,
+            pass_fds=events[1:] if events is not None else (),
+            start_new_session=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
         )
     except Exception as e:
-        update_journal(
-            session=session,
+        if events is not None:
+            os.close(events[0])
+            os.close(events[1])
+        await update_journal_async(
             journal_id=journal_id,
-            journal=(JournalUpdate(active="failed")),
+            journal=(JournalUpdate(active="failed", finished_at=datetime.utcnow())),
         )
         logger.error(
             f"The run_ansible_playbook subprocess module encountered an error:\n{e}"
         )
-        return
-    if process.stdout is not None:
-        for line in iter(process.stdout.readline, ""):
-            try:
-                create_journal_message(
-                    session=session,
-                    journal_message=(
-                        Journal_MessageCreate(
-                            journal_id=journal_id, message=line.rstrip()
-                        )
-                    ),
+        return ActiveEnum.failed
+    events_file = None
+    if events is not None:
+        os.close(events[1])
+        events_file = os.fdopen(events[0], "rb")
+    counts: Counter = Counter()
+    active = None
+    try:
+        async with JournalWriter(journal_id=journal_id) as writer:
+            reading = asyncio.create_task(
+                read_process(
+                    process=process,
+                    events_file=events_file,
+                    writer=writer,
+                    counts=counts,
+                    items=items,
                 )
-            except Exception as e:
-                update_journal(
-                    session=session,
-                    journal_id=journal_id,
-                    journal=(JournalUpdate(active="failed")),
+            )
+            try:
+                active = await supervise_process(
+                    process=process, reading=reading, cancel=cancel, timeout=timeout
                 )
-                logger.error(
-                    f"The create_journal_message function encountered an error:\n{e}"
+            finally:
+                if not reading.done():
+                    signal_process_group(process, signal.SIGKILL)
+                    reading.cancel()
+                    await asyncio.gather(reading, return_exceptions=True)
+            if not reading.cancelled():
+                reading.result()
+            if active == ActiveEnum.cancelled:
+                await writer.write_async("The ansible-playbook process was cancelled")
+            elif active == ActiveEnum.timeout:
+                await writer.write_async(
+                    f"The ansible-playbook process timed out after {timeout} seconds"
                 )
-                return
-        process.stdout.close()
-    return_code = process.wait()
-    update_journal(
-        session=session,
+    except Exception as e:
+        signal_process_group(process, signal.SIGKILL)
+        active = ActiveEnum.failed
+        logger.error(f"The JournalWriter class encountered an error:\n{e}")
+    finally:
+        if process.stdout is not None:
+            process.stdout.close()
+        if events_file is not None:
+            events_file.close()
+    return_code, rusage = await wait_process(process)
+    if active is None:
+        active = ActiveEnum.inactive if return_code == 0 else ActiveEnum.failed
+    await update_journal_async(
+        journal_id=journal_id,
+        journal=(
+            JournalUpdate(
+                active=active,
+                byte_count=counts["bytes"],
+                exit_code=return_code,
+                finished_at=datetime.utcnow(),
+                line_count=counts["lines"],
+                max_rss=rusage.ru_maxrss * 1024,
+                system_time=rusage.ru_stime,
+                user_time=rusage.ru_utime,
+                wall_time=time.monotonic() - started,
+            )
+        ),
+    )
+    return active
+
+
+def open_wheelhouse_lock(wheelhouse_directory: str) -> int:
+    return os.open(f"{wheelhouse_directory}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+
+
+@contextlib.asynccontextmanager
+async def share_wheelhouse(wheelhouse_directory: str) -> AsyncIterator[None]:
+    """Hold a shared lock of the wheelhouse, so it is not pruned meanwhile.
+
+    The lock is a flock of a file next to the wheelhouse, shared by the jobs
+    building and installing wheels in every executor of the host.
+    """
+    fd = open_wheelhouse_lock(wheelhouse_directory)
+    try:
+        await asyncio.to_thread(fcntl.flock, fd, fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+
+def prune_wheelhouse(*, wheelhouse_directory: str, max_size: int) -> list[str]:
+    """Remove the least recently used wheels until the wheelhouse fits `max_size`.
+
+    A wheel is used when pip reads it, so its access time, or its modification
+    time when the filesystem does not update access times, orders the wheels.
+    Nothing is pruned while a job holds the wheelhouse with
+    `share_wheelhouse`, and no job starts using it while it is pruned.
+    Returns the names of the removed wheels.
+    """
+    fd = open_wheelhouse_lock(wheelhouse_directory)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return []
+        wheels = []
+        with os.scandir(wheelhouse_directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".whl"):
+                    stat = entry.stat()
+                    wheels.append(
+                        (max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path)
+                    )
+        size = sum(wheel[1] for wheel in wheels)
+        removed = []
+        for _, wheel_size, path in sorted(wheels):
+            if size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= wheel_size
+            removed.append(os.path.basename(path))
+        return removed
+    finally:
+        os.close(fd)
+
+
+def manage_venv(
+    *, operation: str, venv_directory: str, packages: list[str] | None = None
+) -> tuple[str, bool]:
+    """Run a venv operation and return the function that did it and if it changed."""
+    if operation == "reconcile":
+        return "venvs.venv_package_delta", False
+    if operation == "dedup":
+        linked, reclaimed = venvs.dedup_venv(venv_directory)
+        logger.info(
+            f"The venv dedup linked {linked} files and reclaimed {reclaimed} bytes"
+            f" in {venv_directory}"
+        )
+        return "venvs.dedup_venv", linked > 0
+    if operation == "prune":
+        linked, reclaimed, removed = venvs.prune_venv_store()
+        logger.info(
+            f"The venv store prune linked {linked} files, reclaimed {reclaimed}"
+            f" bytes and removed {removed} stored files"
+        )
+        return "venvs.prune_venv_store", linked > 0 or removed > 0
+    if operation == "clone":
+        if not venvs.clone_venv_template(venv_directory, packages=packages or []):
+            raise FileNotFoundError(
+                "The venv template could not be copied, installing the packages instead"
+            )
+        return "venvs.clone_venv_template", True
+    if operation in ("create", "uninstall") and venvs.take_pool_venv(venv_directory):
+        return "venvs.take_pool_venv", True
+    if operation == "delete":
+        if os.path.lexists(venv_directory):
+            shutil.rmtree(venv_directory)
+        return "shutil.rmtree", True
+    venvs.create_venv(venv_directory, clear=operation == "uninstall")
+    return "venv.EnvBuilder", True
+
+
+async def run_task(
+    *,
+    task: str,
+    journal_id: uuid.UUID,
+    function: Callable[[], tuple[str, bool]],
+    message: str | None = None,
+) -> ActiveEnum:
+    """Run `function` in a worker thread as the single task `task` of a journal.
+
+    The journal goes through the same states and gets the same task event as
+    an ansible-playbook run of the task. `function` returns the action that
+    did the task and if it changed anything, and `message` is reported with
+    the result of the task when it succeeds.
+    """
+    await update_journal_async(
+        journal_id=journal_id,
+        journal=(JournalUpdate(active="activating")),
+    )
+    await update_journal_async(
+        journal_id=journal_id,
+        journal=(JournalUpdate(active="active", started_at=datetime.utcnow())),
+    )
+    started = time.monotonic()
+    started_at = time.time()
+    active = ActiveEnum.inactive
+    action: str | None = None
+    changed = False
+    async with JournalWriter(journal_id=journal_id) as writer:
+        await writer.write_async(f"TASK [{task}]")
+        try:
+            action, changed = await asyncio.to_thread(function)
+            status = "ok"
+            result = f"{'changed' if changed else 'ok'}: [localhost]"
+            if message is not None:
+                result += f" => {json.dumps({'msg': message})}"
+            await writer.write_async(result)
+        except Exception as e:
+            active = ActiveEnum.failed
+            status = "failed"
+            await writer.write_async(f"fatal: [localhost]: FAILED! => {e}")
+            logger.error(f"The run_task function encountered an error:\n{e}")
+        if settings.journal_tasks:
+            await writer.write_task_async(
+                {
+                    "action": action,
+                    "changed": changed,
+                    "duration": time.monotonic() - started,
+                    "finished_at": time.time(),
+                    "host": "localhost",
+                    "started_at": started_at,
+                    "status": status,
+                    "task": task,
+                }
+            )
+    await update_journal_async(
+        journal_id=journal_id,
+        journal=(
+            JournalUpdate(
+                active=active,
+                finished_at=datetime.utcnow(),
+                wall_time=time.monotonic() - started,
+            )
+        ),
+    )
+    return active
+
+
+async def run_venv(
+    *,
+    operation: str,
+    venv_directory: str,
+    journal_id: uuid.UUID,
+    packages: list[str] | None = None,
+) -> ActiveEnum:
+    """Run the create, uninstall or delete task of app/playbooks/venv.yml natively.
+
+    The task runs in a worker thread instead of an ansible-playbook process,
+    and goes through the same journal states and task events. New and cleared
+    venvs are taken from the pool when it is not empty, the clone operation
+    installs `packages` by copying their template, and the reconcile
+    operation records an install with nothing to change. The dedup and prune
+    operations, which have no playbook task, link the files of the venv and
+    of the templates to the store. It is short and is not interrupted by a
+    cancel or a timeout.
+    """
+    return await run_task(
+        task=venv_tasks[operation],
         journal_id=journal_id,
-        journal=(JournalUpdate(active="inactive" if return_code == 0 else "failed")),
+        function=functools.partial(
+            manage_venv,
+            operation=operation,
+            venv_directory=venv_directory,
+            packages=packages,
+        ),
     )
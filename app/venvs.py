@@ -0,0 +1,439 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import stat
+import sys
+import threading
+import uuid
+import venv
+from glob import escape
+from importlib import metadata
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+
+from app.config import settings
+
+
+def create_venv(venv_directory: str, *, clear: bool = False) -> None:
+    builder = venv.EnvBuilder(
+        clear=clear,
+        symlinks=os.name != "nt",
+        upgrade_deps=True,
+        with_pip=True,
+    )
+    builder.create(venv_directory)
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def relocate_venv(
+    venv_directory: str, *, source: str, target: str | None = None
+) -> None:
+    """Rewrite the paths of a venv built in `source` to point to `target`.
+
+    `target` defaults to `venv_directory`. The absolute paths are in
+    pyvenv.cfg, the activate scripts and the shebangs of the scripts in bin.
+    The rewritten files replace the old ones, so files hardlinked to another
+    venv are left untouched.
+    """
+    old, new = os.fsencode(source), os.fsencode(target or venv_directory)
+    directory = Path(venv_directory)
+    for path in [directory / "pyvenv.cfg", *(directory / "bin").iterdir()]:
+        if path.is_symlink() or not path.is_file():
+            continue
+        data = path.read_bytes()
+        if old not in data:
+            continue
+        temporary = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        temporary.write_bytes(data.replace(old, new))
+        shutil.copymode(path, temporary)
+        os.replace(temporary, path)
+
+
+def copy_venv(source: str, venv_directory: str) -> None:
+    """Copy the venv in `source` to `venv_directory`, without relocating it.
+
+    Files are hardlinked when both are on the same filesystem and copied
+    otherwise. pip replaces files instead of writing them in place, so the
+    venvs sharing a file do not see each other's changes.
+    """
+    shutil.copytree(source, venv_directory, symlinks=True, copy_function=link_or_copy)
+
+
+def replace_directory(source: str, directory: str) -> None:
+    if os.path.lexists(directory):
+        shutil.rmtree(directory)
+    os.rename(source, directory)
+
+
+def canonicalize_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def canonicalize_version(version: str) -> str:
+    return re.sub(r"^(\d+(?:\.\d+)*?)(?:\.0)+(?=\D|$)", r"\1", version)
+
+
+def installed_packages(venv_directory: str) -> dict[str, metadata.Distribution]:
+    """Read the packages installed in a venv from their dist-info metadata."""
+    paths = [
+        str(path) for path in Path(venv_directory).glob("lib/python*/site-packages")
+    ]
+    return {
+        canonicalize_name(distribution.metadata["Name"]): distribution
+        for distribution in metadata.distributions(path=paths)
+    }
+
+
+_installed_cache: dict[str, tuple[tuple, list[dict]]] = {}
+_installed_lock = threading.Lock()
+
+
+def site_packages_signature(venv_directory: str) -> tuple:
+    signature = []
+    for path in sorted(Path(venv_directory).glob("lib/python*/site-packages")):
+        stat = path.stat()
+        signature.append((str(path), stat.st_ino, stat.st_mtime_ns))
+    return tuple(signature)
+
+
+def list_installed_packages(venv_directory: str) -> list[dict]:
+    """Return the name, version and requested flag of the installed packages.
+
+    The result is cached per venv until its site-packages directories change,
+    which happens whenever a package is installed or removed, or until
+    `forget_installed_packages` is called.
+    """
+    signature = site_packages_signature(venv_directory)
+    with _installed_lock:
+        cached = _installed_cache.get(venv_directory)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    packages = [
+        {
+            "name": distribution.metadata["Name"],
+            "version": distribution.version,
+            "requested": distribution.read_text("REQUESTED") is not None,
+        }
+        for _, distribution in sorted(installed_packages(venv_directory).items())
+    ]
+    with _installed_lock:
+        _installed_cache[venv_directory] = (signature, packages)
+    return packages
+
+
+def forget_installed_packages(venv_directory: str) -> None:
+    with _installed_lock:
+        _installed_cache.pop(venv_directory, None)
+
+
+def venv_package_delta(
+    venv_directory: str, *, packages: list[str]
+) -> tuple[list[str], list[str]]:
+    """Compare the packages installed in a venv with the desired `packages`.
+
+    Returns the specs of `packages` that are missing or installed with another
+    version, and the names of the packages that were requested earlier, are
+    no longer desired and are not required by another installed package.
+    """
+    installed = installed_packages(venv_directory)
+    desired: set[str] = set()
+    install = []
+    for package in packages:
+        name, _, version = package.partition("==")
+        name = canonicalize_name(re.split(r"[\[<>=!~;\s]", name, maxsplit=1)[0])
+        desired.add(name)
+        distribution = installed.get(name)
+        if distribution is None or (
+            version
+            and canonicalize_version(distribution.version)
+            != canonicalize_version(version)
+        ):
+            install.append(package)
+    remove = {
+        name
+        for name, distribution in installed.items()
+        if name not in desired
+        and name not in ("pip", "setuptools", "wheel")
+        and distribution.read_text("REQUESTED") is not None
+    }
+    while True:
+        required = {
+            canonicalize_name(re.split(r"[\[<>=!~;\s(]", requirement, maxsplit=1)[0])
+            for name, distribution in installed.items()
+            if name not in remove
+            for requirement in distribution.requires or []
+            if "extra ==" not in requirement
+        }
+        if not remove & required:
+            break
+        remove -= required
+    return install, sorted(remove)
+
+
+def venv_packages_pinned(packages: list[str]) -> bool:
+    """Return whether every spec of `packages` pins an exact version."""
+    return bool(packages) and all(
+        re.fullmatch(r"[A-Za-z0-9._-]+(\[[^\]]*\])?\s*==\s*[^\s*,;<>=!~]+", package)
+        for package in packages
+    )
+
+
+def venv_packages_key(packages: list[str]) -> str:
+    data = json.dumps({"packages": sorted(packages), "python": sys.version})
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def read_lock_report(report: str) -> list[dict]:
+    """Read the packages of a `pip install --dry-run --report` installation report.
+
+    Each package has its name, version, download url and hashes. The hash of
+    a local archive, like a wheel of the wheelhouse, is computed when pip did
+    not report it.
+    """
+    with open(report) as file:
+        data = json.load(file)
+    packages = []
+    for item in data["install"]:
+        download_info = item["download_info"]
+        archive_info = download_info.get("archive_info", {})
+        hashes = dict(archive_info.get("hashes", {}))
+        if not hashes and "hash" in archive_info:
+            algorithm, _, value = archive_info["hash"].partition("=")
+            hashes[algorithm] = value
+        url = urlparse(download_info["url"])
+        if "sha256" not in hashes and url.scheme == "file":
+            with open(unquote(url.path), "rb") as file:
+                hashes["sha256"] = hashlib.file_digest(file, "sha256").hexdigest()
+        packages.append(
+            {
+                "name": item["metadata"]["name"],
+                "version": item["metadata"]["version"],
+                "url": download_info["url"],
+                "hashes": [
+                    f"{algorithm}:{value}"
+                    for algorithm, value in sorted(hashes.items())
+                ],
+            }
+        )
+    return sorted(packages, key=lambda package: canonicalize_name(package["name"]))
+
+
+def write_lock_requirements(requirements: str, *, packages: list[dict]) -> bool:
+    """Write the pinned `packages` of a lock as a requirements file.
+
+    Returns whether every package has a hash, so pip can be run with
+    --require-hashes.
+    """
+    hashed = True
+    with open(requirements, "w") as file:
+        for package in packages:
+            line = f"{package['name']}=={package['version']}"
+            for value in package["hashes"]:
+                line += f" --hash={value}"
+            hashed = hashed and bool(package["hashes"])
+            file.write(line + "\n")
+    return hashed
+
+
+def clone_venv_template(venv_directory: str, *, packages: list[str]) -> bool:
+    """Replace `venv_directory` by a copy of the template of `packages`.
+
+    Returns False when there is no template for this package set, or when the
+    copy failed, like when the template is pruned while it is copied. The
+    partial copy is removed.
+    """
+    template = str(
+        Path(settings.venv_template_dir).resolve() / venv_packages_key(packages)
+    )
+    clone = f"{venv_directory}.{uuid.uuid4().hex}"
+    try:
+        os.utime(template)
+        copy_venv(template, clone)
+    except OSError:
+        shutil.rmtree(clone, ignore_errors=True)
+        return False
+    relocate_venv(clone, source=template, target=venv_directory)
+    replace_directory(clone, venv_directory)
+    return True
+
+
+def save_venv_template(venv_directory: str, *, packages: list[str]) -> None:
+    """Save `venv_directory`, with `packages` installed, as their template.
+
+    Only the package sets pinning an exact version of each package get a
+    template, since a new install of other specs could resolve newer versions.
+    The template is copied in a hidden directory and renamed once complete,
+    and the least recently used templates beyond `venv_template_max` are
+    removed.
+    """
+    if settings.venv_template_max <= 0 or not venv_packages_pinned(packages):
+        return
+    template_directory = Path(settings.venv_template_dir).resolve()
+    template = str(template_directory / venv_packages_key(packages))
+    if os.path.isdir(template):
+        return
+    building = str(template_directory / f".{uuid.uuid4().hex}")
+    try:
+        copy_venv(venv_directory, building)
+        relocate_venv(building, source=venv_directory, target=template)
+        os.rename(building, template)
+    except OSError:
+        shutil.rmtree(building, ignore_errors=True)
+        return
+    templates = sorted(
+        (entry.stat().st_mtime, entry.path)
+        for entry in os.scandir(template_directory)
+        if entry.is_dir() and not entry.name.startswith(".")
+    )
+    for _, path in templates[: -settings.venv_template_max]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def take_pool_venv(venv_directory: str) -> bool:
+    """Move an empty venv of the pool to `venv_directory`.
+
+    Returns False when the pool is empty.
+    """
+    for entry in os.scandir(Path(settings.venv_pool_dir).resolve()):
+        if entry.name.startswith("."):
+            continue
+        try:
+            replace_directory(entry.path, venv_directory)
+        except FileNotFoundError:
+            continue
+        relocate_venv(venv_directory, source=entry.path)
+        return True
+    return False
+
+
+def fill_venv_pool() -> bool:
+    """Build one empty venv when the pool has less than `venv_pool_size`.
+
+    Returns whether a venv was built.
+    """
+    pool_directory = Path(settings.venv_pool_dir).resolve()
+    ready = [
+        entry for entry in os.scandir(pool_directory) if not entry.name.startswith(".")
+    ]
+    if len(ready) >= settings.venv_pool_size:
+        return False
+    name = uuid.uuid4().hex
+    building = str(pool_directory / f".{name}")
+    pooled = str(pool_directory / name)
+    try:
+        create_venv(building)
+        relocate_venv(building, source=building, target=pooled)
+        os.rename(building, pooled)
+    except BaseException:
+        shutil.rmtree(building, ignore_errors=True)
+        raise
+    return True
+
+
+def restamp_bytecode(source: str, source_stat: os.stat_result) -> None:
+    """Update the source mtime recorded in the timestamp-based pycs of `source`.
+
+    The pycs stay valid when the source is replaced by a file with the same
+    content and another mtime, like a hardlink to the store.
+    """
+    directory, name = os.path.split(source)
+    mtime = int(source_stat.st_mtime) & 0xFFFFFFFF
+    size = source_stat.st_size & 0xFFFFFFFF
+    pycache = Path(directory) / "__pycache__"
+    for path in pycache.glob(f"{escape(name[:-3])}.*.pyc"):
+        data = path.read_bytes()
+        if (
+            len(data) < 16
+            or int.from_bytes(data[4:8], "little") != 0
+            or int.from_bytes(data[12:16], "little") != size
+        ):
+            continue
+        temporary = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        temporary.write_bytes(data[:8] + mtime.to_bytes(4, "little") + data[12:])
+        os.replace(temporary, path)
+
+
+def dedup_venv(venv_directory: str) -> tuple[int, int]:
+    """Replace the files of a venv by hardlinks to the content-addressed store.
+
+    Files are stored by the sha256 of their content and their mode. pip and
+    `relocate_venv` replace files instead of writing them in place, so an
+    upgraded file gets its own inode and the others keep the stored one.
+    pycs embed the path of their venv and are left as they are. Returns the
+    number of files linked and the bytes reclaimed.
+    """
+    store = Path(settings.venv_store_dir).resolve()
+    linked = reclaimed = 0
+    for site_packages in Path(venv_directory).glob("lib/python*/site-packages"):
+        for root, _, names in os.walk(site_packages):
+            for name in names:
+                if name.endswith(".pyc"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    path_stat = os.lstat(path)
+                    if not stat.S_ISREG(path_stat.st_mode) or not path_stat.st_size:
+                        continue
+                    with open(path, "rb") as file:
+                        digest = hashlib.file_digest(file, "sha256").hexdigest()
+                    mode = stat.S_IMODE(path_stat.st_mode)
+                    stored = store / digest[:2] / f"{digest}-{mode:o}"
+                    try:
+                        stored_stat = os.stat(stored)
+                    except FileNotFoundError:
+                        stored.parent.mkdir(exist_ok=True)
+                        os.link(path, stored)
+                        continue
+                    if stored_stat.st_ino == path_stat.st_ino:
+                        continue
+                    temporary = os.path.join(root, f".{name}.{uuid.uuid4().hex}")
+                    os.link(stored, temporary)
+                    os.replace(temporary, path)
+                except (FileExistsError, FileNotFoundError):
+                    continue
+                linked += 1
+                if path_stat.st_nlink == 1:
+                    reclaimed += path_stat.st_size
+                if name.endswith(".py") and stored_stat.st_mtime != path_stat.st_mtime:
+                    restamp_bytecode(path, stored_stat)
+    return linked, reclaimed
+
+
+# The unit of the jobs pruning the venv store, which is shared by all venvs.
+venv_store_unit = uuid.uuid5(uuid.NAMESPACE_URL, "venv_store")
+
+
+def prune_venv_store() -> tuple[int, int, int]:
+    """Deduplicate the venv templates and remove the unused files of the store.
+
+    The venvs are deduplicated by their own jobs. Templates are only replaced
+    or removed as a whole, so their files can be relinked at any time. A
+    stored file is unused once no venv or template links to it. Returns the
+    number of files linked, the bytes reclaimed and the stored files removed.
+    """
+    linked = reclaimed = 0
+    for entry in os.scandir(Path(settings.venv_template_dir).resolve()):
+        if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+            continue
+        template_linked, template_reclaimed = dedup_venv(entry.path)
+        linked += template_linked
+        reclaimed += template_reclaimed
+    removed = 0
+    for root, _, names in os.walk(Path(settings.venv_store_dir).resolve()):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                if os.lstat(path).st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+    return linked, reclaimed, removed
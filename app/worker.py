@@ -0,0 +1,28 @@
+import logging
+import signal
+import threading
+
+from app.config import create_directories
+from app.database import create_db_and_tables
+from app.executor import executor
+
+logger = logging.getLogger("uvicorn")
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    create_directories()
+    create_db_and_tables()
+    stopping = threading.Event()
+    signal.signal(signal.SIGINT, lambda *args: stopping.set())
+    signal.signal(signal.SIGTERM, lambda *args: stopping.set())
+    executor.recover()
+    executor.start()
+    logger.info(f"The executor {executor.name} started {executor.workers} workers")
+    stopping.wait()
+    logger.info(f"The executor {executor.name} is waiting for its running jobs")
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
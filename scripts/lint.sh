@@ -11,4 +11,4 @@ ruff format app --check
 yamllint app/playbooks
 
 ansible-lint app/playbooks
-ansible-playbook --inventory localhost, --syntax-check app/playbooks/*
+ansible-playbook --inventory localhost, --syntax-check app/playbooks/*.yml